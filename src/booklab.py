@@ -1,138 +1,1239 @@
 import os
 import sys
-import pygments
-from rich.console import Console
-from rich.syntax import Syntax
-from rich.panel import Panel
-from rich.tree import Tree
-from rich.progress import track
-from rich.text import Text
-from rich.layout import Layout
-from rich.prompt import Prompt
-from rich.table import Table
-from rich.markdown import Markdown
 import time
-import shutil
-import difflib
-from pygments import lexers, formatters
+
+from telemetry import Telemetry
+
+# Wall and CPU time of commands, filesystem operations and rendering, kept for stats:
+timings = Telemetry(capacity=10_000)
+
+
+@timings.timed("fs")
+def scan_entries(path):
+    """List a directory as [name, is_dir, size, mtime_ns] entries from a single scandir pass."""
+    entries = []
+    with os.scandir(path) as scan:
+        for entry in scan:
+            try:
+                stats = entry.stat(follow_symlinks=False)
+                entries.append([entry.name, entry.is_dir(follow_symlinks=False), stats.st_size, stats.st_mtime_ns])
+            except OSError:
+                continue
+    return entries
+
+
+def entry_stat(entry):
+    """Stat a DirEntry's target, or the link itself when it is broken; None if it has gone."""
+    try:
+        return entry.stat()
+    except FileNotFoundError:
+        try:
+            return entry.stat(follow_symlinks=False)
+        except OSError:
+            return None
+    except OSError:
+        return None
+
+
+class DirectoryIndex:
+    """Directory listings under one root, cached on disk between runs.
+
+    Each directory's entries are stored with the directory's own mtime, and a
+    directory whose mtime hasn't changed is not listed again. Entries are
+    (name, is_dir, size, mtime_ns) lists. Adding, removing or renaming a file
+    changes its directory's mtime, but rewriting a file in place does not, so
+    cached sizes and mtimes can lag behind; names are always current. A
+    fresh index lists every directory again and only writes the cache.
+    """
+
+    cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "booklab", "index")
+
+    def __init__(self, root, fresh=False):
+        import hashlib
+        self.fresh = fresh
+        self.root = os.path.abspath(root)
+        self.path = os.path.join(self.cache_dir, hashlib.sha1(self.root.encode()).hexdigest() + ".json")
+        self.dirs = self.load()
+        self.listed = 0
+        self.dropped = 0
+
+    @timings.timed("fs", "index load")
+    def load(self):
+        import json
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        return data["dirs"] if data.get("root") == self.root else {}
+
+    @timings.timed("fs", "index save")
+    def save(self):
+        import json
+        if not self.listed and not self.dropped:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"root": self.root, "dirs": self.dirs}, file, separators=(",", ":"))
+        os.replace(temp_path, self.path)
+
+    def list_dir(self, path):
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.dirs.get(path)
+        if cached is not None and cached[0] == mtime and not self.fresh:
+            return cached[1]
+        entries = scan_entries(path)
+        self.dirs[path] = [mtime, entries]
+        self.listed += 1
+        return entries
+
+    def walk(self, workers=None):
+        """Yield (directory, entries) for every directory under the root as its listing arrives.
+
+        Directories are listed concurrently on a thread pool. Once the walk
+        finishes, directories that no longer exist are dropped from the index.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        visited = {}
+        with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as pool:
+            pending = {pool.submit(self.list_dir, self.root): self.root}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        entries = future.result()
+                    except OSError:
+                        continue
+                    visited[path] = self.dirs[path]
+                    for name, is_dir, _, _ in entries:
+                        if is_dir:
+                            subdirectory = os.path.join(path, name)
+                            pending[pool.submit(self.list_dir, subdirectory)] = subdirectory
+                    yield path, entries
+        self.dropped = len(set(self.dirs) - set(visited))
+        self.dirs = visited
+
+
+def name_matcher(pattern):
+    """Match names by 're:<regex>', by glob if the pattern has wildcards, or else by substring.
+
+    All three ignore case, and an empty pattern matches everything.
+    """
+    import re
+    import fnmatch
+    if pattern.startswith("re:"):
+        return re.compile(pattern[3:], re.IGNORECASE).search
+    if any(char in pattern for char in "*?["):
+        return re.compile(fnmatch.translate(pattern), re.IGNORECASE).match
+    lowered = pattern.lower()
+    return lambda name: lowered in name.lower()
+
+
+@timings.timed("fs")
+def grep_file(path, regex, limit=5):
+    """Return up to limit (line number, line) matches of a bytes regex, or [] for binary files."""
+    matches = []
+    try:
+        with open(path, "rb") as file:
+            if b"\0" in file.read(8192):
+                return matches
+            file.seek(0)
+            for number, line in enumerate(file, 1):
+                if regex.search(line):
+                    matches.append((number, line.decode("utf-8", "replace").rstrip()))
+                    if len(matches) >= limit:
+                        break
+    except OSError:
+        pass
+    return matches
+
+
+class MappedFile:
+    """A file mapped read-only into memory, with a line-offset index built as it is needed.
+
+    The index keeps the byte offset of every STRIDE-th line and only extends
+    as far as the lines asked for, so opening a large file or showing its
+    first page costs nothing like reading it. Lines are returned as text,
+    with undecodable bytes replaced.
+    """
+
+    STRIDE = 256
+
+    @timings.timed("fs", "map file")
+    def __init__(self, path):
+        from array import array
+        import mmap
+        self.path = path
+        with open(path, "rb") as file:
+            self.size = os.fstat(file.fileno()).st_size
+            # Empty files can't be mapped; they simply have no lines
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.checkpoints = array("Q", [0])
+        self.scanned = 0
+        self.scanned_lines = 0
+        self.complete = self.size == 0
+        self.total = None
+
+    def close(self):
+        if self.size:
+            self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def next_line(self, offset):
+        end = self.map.find(b"\n", offset)
+        return self.size if end < 0 else end + 1
+
+    @timings.timed("fs", "index lines")
+    def index_more(self, chunk=1 << 22):
+        """Extend the checkpoints over the next chunk of the file."""
+        from itertools import accumulate
+        data = self.map[self.scanned:self.scanned + chunk]
+        cut = data.rfind(b"\n") + 1
+        if not cut:
+            if self.scanned + len(data) < self.size:
+                # A line longer than the chunk; look further ahead next time
+                return self.index_more(chunk * 2)
+            cut = len(data)
+        # Splitting and summing lengths finds every line end without a Python-level loop per line;
+        # line k of the chunk ends at ends[k] plus the k newlines before it
+        ends = list(accumulate(map(len, data[:cut].split(b"\n")[:-1])))
+        first = -(self.scanned_lines + 1) % self.STRIDE
+        for k in range(first, len(ends), self.STRIDE):
+            start = self.scanned + ends[k] + k + 1
+            if start < self.size:
+                self.checkpoints.append(start)
+        self.scanned += cut
+        self.scanned_lines += len(ends)
+        self.complete = self.scanned >= self.size
+
+    def line_offset(self, line):
+        """Byte offset where 0-based line starts, or None past the end of the file."""
+        block = line // self.STRIDE
+        while len(self.checkpoints) <= block and not self.complete:
+            self.index_more()
+        if block >= len(self.checkpoints):
+            return None
+        offset = self.checkpoints[block]
+        for _ in range(line % self.STRIDE):
+            offset = self.next_line(offset)
+        return offset if offset < self.size else None
+
+    def lines(self, start, count):
+        """Return up to count lines from 0-based line start."""
+        offset = self.line_offset(start)
+        if offset is None:
+            return []
+        result = []
+        while len(result) < count and offset < self.size:
+            end = self.next_line(offset)
+            result.append(self.map[offset:end].decode("utf-8", "replace").rstrip("\r\n"))
+            offset = end
+        return result
+
+    def line_count(self):
+        # Counting newlines chunk by chunk runs at memory speed, far faster than indexing lines
+        if self.total is None:
+            chunk = 1 << 24
+            newlines = sum(self.map[position:position + chunk].count(b"\n")
+                           for position in range(0, self.size, chunk))
+            partial = self.size and self.map[self.size - 1:self.size] != b"\n"
+            self.total = newlines + bool(partial)
+        return self.total
+
+    def tail(self, count):
+        """Return (first line number, lines) for the last count lines, scanning back from the end."""
+        end = self.size
+        if end and self.map[end - 1:end] == b"\n":
+            end -= 1
+        offset = end
+        for _ in range(count):
+            offset = self.map.rfind(b"\n", 0, offset)
+            if offset < 0:
+                break
+        start = offset + 1 if offset >= 0 else 0
+        # With the one terminating newline stripped, the lines are exactly what '\n' separates,
+        # so a blank last line is kept and an empty file has none
+        text = self.map[start:end].decode("utf-8", "replace")
+        lines = [line.rstrip("\r") for line in text.split("\n")] if self.size else []
+        return self.line_count() - len(lines) + 1, lines
+
+    def lexer(self):
+        """Pick a lexer from the file name, or failing that from the first few KB."""
+        from pygments import lexers
+        from pygments.util import ClassNotFound
+        try:
+            return lexers.get_lexer_for_filename(self.path)
+        except ClassNotFound:
+            pass
+        try:
+            return lexers.guess_lexer(self.map[:4096].decode("utf-8", "replace"))
+        except ClassNotFound:
+            return lexers.TextLexer()
+
+
+@timings.timed("fs")
+def looks_binary(path):
+    with open(path, "rb") as file:
+        return b"\0" in file.read(8192)
+
+
+@timings.timed("fs")
+def same_contents(path1, path2, chunk=1 << 20):
+    """Compare two files byte for byte, stopping at the first differing chunk."""
+    if os.path.samefile(path1, path2):
+        return True
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    with open(path1, "rb") as file1, open(path2, "rb") as file2:
+        while True:
+            block = file1.read(chunk)
+            if block != file2.read(chunk):
+                return False
+            if not block:
+                return True
+
+
+@timings.timed("fs")
+def line_hashes(path):
+    from array import array
+    with open(path, "rb") as file:
+        return array("q", map(hash, file))
+
+
+def common_run(a, b, i, j, limit, direction):
+    """Length of the common run of a and b going forward from i and j, or back from them.
+
+    Slices are compared in growing steps, at C speed, and the step shrinks
+    again around the first difference.
+    """
+    size, step = 0, 64
+    while size < limit:
+        step = min(step, limit - size)
+        if direction > 0:
+            same = a[i + size:i + size + step] == b[j + size:j + size + step]
+        else:
+            same = a[i - size - step:i - size] == b[j - size - step:j - size]
+        if same:
+            size += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step //= 2
+    return size
+
+
+def longest_increasing(pairs):
+    """Longest run of (i, j) pairs, in order, whose j values increase, by patience sorting."""
+    from bisect import bisect_left
+    tails, tail_pairs, previous = [], [], []
+    for pair in pairs:
+        slot = bisect_left(tails, pair[1])
+        previous.append(tail_pairs[slot - 1] if slot else None)
+        if slot == len(tails):
+            tails.append(pair[1])
+            tail_pairs.append(len(previous) - 1)
+        else:
+            tails[slot] = pair[1]
+            tail_pairs[slot] = len(previous) - 1
+    result = []
+    index = tail_pairs[-1] if tail_pairs else None
+    while index is not None:
+        result.append(pairs[index])
+        index = previous[index]
+    result.reverse()
+    return result
+
+
+def window_match(a, b, alo, ahi, blo, bhi, size):
+    """Matching blocks between the first size items of both ranges, widening until some are found.
+
+    Returns [] once the window covers both ranges, leaving them to be
+    matched whole.
+    """
+    while size < ahi - alo or size < bhi - blo:
+        blocks = list(matching_blocks(a[alo:min(alo + size, ahi)], b[blo:min(blo + size, bhi)]))
+        if blocks:
+            return [(alo + i, blo + j, n) for i, j, n in blocks]
+        size *= 2
+    return []
+
+
+def matching_blocks(a, b, window_size=512):
+    """Yield (i, j, n) runs of equal items in a and b, in order, by patience diff.
+
+    Common prefixes and suffixes are trimmed first, then lines that occur
+    exactly once on each side anchor the match and the gaps between anchors
+    are matched the same way. Gaps with no unique lines fall back to difflib
+    when they are small and are otherwise treated as wholly changed. Long
+    ranges are matched a window at a time from the front, so the cost
+    follows the size of the changes rather than of the files.
+    """
+    import operator
+    from collections import Counter
+    stack = [("range", 0, len(a), 0, len(b))]
+    while stack:
+        kind, *bounds = stack.pop()
+        if kind == "block":
+            if bounds[2]:
+                yield tuple(bounds)
+            continue
+        alo, ahi, blo, bhi = bounds
+        prefix = common_run(a, b, alo, blo, min(ahi - alo, bhi - blo), 1)
+        if prefix:
+            yield alo, blo, prefix
+        alo += prefix
+        blo += prefix
+        suffix = common_run(a, b, ahi, bhi, min(ahi - alo, bhi - blo), -1)
+        ahi -= suffix
+        bhi -= suffix
+        items = []
+        window = window_match(a, b, alo, ahi, blo, bhi, window_size)
+        if window:
+            # Take the matches near the start and go on from the last one,
+            # which the next prefix scan extends past the window's edge
+            for i, j, n in window[:-1]:
+                items.append(("block", i, j, n))
+            i, j, _ = window[-1]
+            items.append(("range", i, ahi, j, bhi))
+        elif alo < ahi and blo < bhi:
+            counts_a = Counter(a[alo:ahi])
+            counts_b = Counter(b[blo:bhi])
+            unique_b = {b[j]: j for j in range(blo, bhi) if counts_b[b[j]] == 1}
+            pairs = [(i, unique_b[a[i]]) for i in range(alo, ahi)
+                     if counts_a[a[i]] == 1 and a[i] in unique_b]
+            positions = [j for _, j in pairs]
+            if all(map(operator.lt, positions, positions[1:])):
+                # Nothing moved, the usual case: every unique pair is an anchor
+                anchors = pairs
+            else:
+                anchors = longest_increasing(pairs)
+            if anchors:
+                # Runs of consecutive anchors become one block, with no gap to match between them
+                i, j = alo, blo
+                run_a, run_b, run = anchors[0][0], anchors[0][1], 0
+                for anchor_a, anchor_b in anchors:
+                    if anchor_a == run_a + run and anchor_b == run_b + run:
+                        run += 1
+                        continue
+                    items.append(("range", i, run_a, j, run_b))
+                    items.append(("block", run_a, run_b, run))
+                    i, j = run_a + run, run_b + run
+                    run_a, run_b, run = anchor_a, anchor_b, 1
+                items.append(("range", i, run_a, j, run_b))
+                items.append(("block", run_a, run_b, run))
+                items.append(("range", run_a + run, ahi, run_b + run, bhi))
+            elif (ahi - alo) * (bhi - blo) <= 4_000_000:
+                from difflib import SequenceMatcher
+                matcher = SequenceMatcher(None, a[alo:ahi], b[blo:bhi], autojunk=False)
+                for i, j, n in matcher.get_matching_blocks():
+                    items.append(("block", alo + i, blo + j, n))
+        items.append(("block", ahi, bhi, suffix))
+        stack.extend(reversed(items))
+
+
+def diff_hunks(a, b, context=3):
+    """Yield unified-diff hunks of a and b as lists of (tag, i1, i2, j1, j2) ops.
+
+    Tags are 'equal' and 'change'; hunks are produced as the matching
+    blocks arrive, so the first can be shown before the rest are found.
+    """
+    from itertools import chain
+    hunk = []
+    equal = None
+    position_a = position_b = 0
+    # The empty block at the end flushes a trailing change
+    for i, j, n in chain(matching_blocks(a, b), [(len(a), len(b), 0)]):
+        if i > position_a or j > position_b:
+            if equal:
+                _, e1, e2, f1, f2 = equal
+                if hunk and e2 - e1 <= 2 * context:
+                    hunk.append(equal)
+                else:
+                    if hunk:
+                        yield hunk + [("equal", e1, e1 + context, f1, f1 + context)]
+                    lead = min(context, e2 - e1)
+                    hunk = [("equal", e2 - lead, e2, f2 - lead, f2)]
+                equal = None
+            hunk.append(("change", position_a, i, position_b, j))
+        if n:
+            if equal:
+                equal = ("equal", equal[1], i + n, equal[3], j + n)
+            else:
+                equal = ("equal", i, i + n, j, j + n)
+        position_a, position_b = i + n, j + n
+    if hunk:
+        if equal:
+            _, e1, e2, f1, f2 = equal
+            hunk.append(("equal", e1, min(e2, e1 + context), f1, min(f2, f1 + context)))
+        yield hunk
+
+
+def differing_ranges(path1, path2, block=1 << 16):
+    """Yield (start, end) byte ranges where two binary files differ, up to the shorter length.
+
+    Each range is a maximal run of differing bytes. Blocks that differ are
+    XORed as integers, so the runs are found by a regex over the non-zero
+    bytes rather than by a Python-level loop per byte.
+    """
+    import mmap
+    import re
+    nonzero = re.compile(rb"[^\x00]+")
+    with open(path1, "rb") as file1, open(path2, "rb") as file2:
+        size = min(os.fstat(file1.fileno()).st_size, os.fstat(file2.fileno()).st_size)
+        if not size:
+            return
+        with mmap.mmap(file1.fileno(), 0, access=mmap.ACCESS_READ) as map1, \
+                mmap.mmap(file2.fileno(), 0, access=mmap.ACCESS_READ) as map2:
+            start = None  # a run still open at the end of the previous block
+            for offset in range(0, size, block):
+                chunk1 = map1[offset:min(offset + block, size)]
+                chunk2 = map2[offset:min(offset + block, size)]
+                if chunk1 == chunk2:
+                    if start is not None:
+                        yield start, offset
+                        start = None
+                    continue
+                xor = int.from_bytes(chunk1, "big") ^ int.from_bytes(chunk2, "big")
+                for match in nonzero.finditer(xor.to_bytes(len(chunk1), "big")):
+                    if start is not None and match.start() > 0:
+                        yield start, offset
+                        start = None
+                    if start is None:
+                        start = offset + match.start()
+                    if match.end() < len(chunk1):
+                        yield start, offset + match.end()
+                        start = None
+            if start is not None:
+                yield start, size
+
+
+def hunk_range(start, end):
+    # Unified diff ranges are 1-based; an empty range names the line before it
+    length = end - start
+    if length == 1:
+        return str(start + 1)
+    return f"{start + 1},{length}" if length else f"{start},0"
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+@timings.timed("fs")
+def copy_data(source, destination, offset=0, report=None, chunk=1 << 23):
+    """Copy a file's bytes from offset on, inside the kernel where the OS allows it.
+
+    Uses os.copy_file_range, then os.sendfile on Linux, then plain reads and
+    writes; report is called with the size of each chunk as it lands.
+    Returns the number of bytes copied.
+    """
+    import errno
+    unsupported = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+    with open(source, "rb") as src, open(destination, "r+b" if offset else "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        position = offset
+        fast = hasattr(os, "copy_file_range") or (hasattr(os, "sendfile") and sys.platform.startswith("linux"))
+        while position < size:
+            count = min(chunk, size - position)
+            if fast:
+                try:
+                    if hasattr(os, "copy_file_range"):
+                        sent = os.copy_file_range(src.fileno(), dst.fileno(), count, position, position)
+                    else:
+                        os.lseek(dst.fileno(), position, os.SEEK_SET)
+                        sent = os.sendfile(dst.fileno(), src.fileno(), position, count)
+                except OSError as e:
+                    if e.errno not in unsupported or position > offset:
+                        raise
+                    fast = False
+                    continue
+            else:
+                src.seek(position)
+                dst.seek(position)
+                data = src.read(count)
+                sent = dst.write(data)
+            if not sent:
+                break  # the source shrank while being copied
+            position += sent
+            if report:
+                report(sent)
+        dst.truncate(position)
+    return position - offset
+
+
+@timings.timed("fs")
+def file_digest(path):
+    import hashlib
+    digest = hashlib.blake2b()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def transfer_pairs(source, destination):
+    """Expand the source of a copy or move into (path, target) pairs.
+
+    source may be a glob, and recursive '**' patterns are allowed. With
+    several sources, or an existing directory as destination, each source
+    goes inside the destination; otherwise the destination is the new name.
+    A source whose target is the source itself, or a link to it, is refused.
+    """
+    import glob
+    sources = sorted(glob.glob(source, recursive=True)) if glob.has_magic(source) else [source]
+    sources = [path for path in sources if os.path.lexists(path)]
+    if not sources:
+        raise FileNotFoundError(f"No files match '{source}'.")
+    into = os.path.isdir(destination) or len(sources) > 1
+    if into:
+        os.makedirs(destination, exist_ok=True)
+    pairs = [(path, os.path.join(destination, os.path.basename(os.path.normpath(path))) if into else destination)
+             for path in sources]
+    for path, target in pairs:
+        check_not_same(path, target)
+    return pairs
+
+
+def check_not_same(path, target):
+    # Opening the target for writing would truncate the source before it is read
+    if os.path.exists(target) and os.path.samefile(path, target):
+        raise OSError(f"'{path}' and '{target}' are the same file.")
+
+
+def tree_jobs(path, target):
+    """Return (directories to create, file jobs) for copying path to target.
+
+    Directories are walked with scandir, reusing its cached stat results.
+    Jobs are (source, target, size) tuples; symlinks inside directories are
+    recreated as links and have a size of None.
+    """
+    if not os.path.isdir(path):
+        return [], [(path, target, os.path.getsize(path))]
+    if os.path.commonpath([os.path.abspath(path), os.path.abspath(target)]) == os.path.abspath(path):
+        raise OSError(f"Cannot copy '{path}' into itself.")
+    directories, jobs = [], []
+    pending = [(path, target)]
+    while pending:
+        directory, target_directory = pending.pop()
+        directories.append(target_directory)
+        with os.scandir(directory) as scan:
+            for entry in scan:
+                entry_target = os.path.join(target_directory, entry.name)
+                if entry.is_symlink():
+                    jobs.append((entry.path, entry_target, None))
+                elif entry.is_dir():
+                    pending.append((entry.path, entry_target))
+                else:
+                    jobs.append((entry.path, entry_target, entry.stat().st_size))
+    return directories, jobs
+
+
+@timings.timed("fs")
+def partial_digest(path, size=1 << 16):
+    import hashlib
+    with open(path, "rb") as file:
+        return hashlib.blake2b(file.read(size)).hexdigest()
+
+
+def regroup(groups, digest, report=None, workers=None):
+    """Split (size, paths) groups by a digest of each file, keeping the parts with two or more files.
+
+    Files are hashed concurrently on a thread pool; files that can't be read
+    are left out, and report is called with each file's size once hashed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def hash_one(job):
+        path, size = job
+        try:
+            return digest(path)
+        except OSError:
+            return None
+        finally:
+            if report:
+                report(size)
+
+    jobs = [(path, size) for size, paths in groups for path in paths]
+    with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as pool:
+        digests = dict(zip((path for path, _ in jobs), pool.map(hash_one, jobs)))
+    result = []
+    for size, paths in groups:
+        split = {}
+        for path in paths:
+            if digests[path] is not None:
+                split.setdefault(digests[path], []).append(path)
+        result.extend((size, same) for same in split.values() if len(same) > 1)
+    return result
+
+
+def timed_console(**options):
+    """A rich Console whose print() calls are recorded as render spans."""
+    from rich.console import Console
+    console = Console(**options)
+    console.print = timings.timed("render", "print")(console.print)
+    return console
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:.3f} ms"
+
+
+def write_rows(path, rows):
+    """Write a list of dicts to path, as JSON if it ends in .json and as CSV otherwise."""
+    import csv
+    import json
+    with open(path, "w", newline="") as file:
+        if path.lower().endswith(".json"):
+            json.dump(rows, file, indent=1)
+        elif rows:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
 
 
 class BookLAB:
+    # rich, pygments, shutil and difflib are imported by the commands that use them,
+    # so importing BookLAB and starting it stay fast
+    page_lines = 100
+
     def __init__(self):
-        self.console = Console()
+        self.console = timed_console()
         self.current_path = os.getcwd()
+        self.failed = False
+        self.tables = None
+        self.listings = {}
 
     def display_prompt(self, cell_number):
         self.console.print(f"[bold green]Cell {cell_number}:[/bold green] ", end="")
         return input()
 
-    def list_files(self):
-        files = os.listdir(self.current_path)
+    @timings.timed("fs")
+    def sorted_entries(self, path, sort_by):
+        """A directory's DirEntry objects sorted by 'name', 'size' or 'mtime', cached until its mtime changes.
+
+        A DirEntry knows whether it is a directory without a system call and
+        keeps its stat result once asked, so sorting by name stats nothing
+        and each entry is stat'ed at most once for as long as it is cached.
+        As with DirectoryIndex, a file rewritten in place keeps its old size
+        and mtime here until something is added to or removed from its
+        directory.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.listings.get(path)
+        if cached is None or cached[0] != mtime:
+            with os.scandir(path) as scan:
+                cached = (mtime, {None: list(scan)})  # None holds scandir's own order
+            self.listings[path] = cached
+        orders = cached[1]
+        if sort_by not in orders:
+            entries = orders[None]
+            if sort_by == "size":
+                orders[sort_by] = sorted(entries, key=lambda entry: (entry.is_dir(), -getattr(entry_stat(entry), "st_size", 0)))
+            elif sort_by == "mtime":
+                orders[sort_by] = sorted(entries, key=lambda entry: -getattr(entry_stat(entry), "st_mtime_ns", 0))
+            else:
+                orders[sort_by] = sorted(entries, key=lambda entry: entry.name.casefold())
+        return orders[sort_by]
+
+    def list_files(self, sort_by="name", page=1, show_all=False):
+        from rich.table import Table
+        entries = self.sorted_entries(self.current_path, sort_by)
+        pages = max(1, -(-len(entries) // self.page_lines))
+        if show_all:
+            first, shown = 0, entries
+        else:
+            if page > pages:
+                self.error(f"There are only {pages} pages.")
+                return
+            first = (page - 1) * self.page_lines
+            shown = entries[first:first + self.page_lines]
+        # Only the rows being shown are stat'ed and formatted, however large the directory
         table = Table(title="Files in Directory", style="cyan")
         table.add_column("Index", justify="center")
         table.add_column("Filename", justify="left")
-
-        for i, file in enumerate(files, 1):
-            table.add_row(str(i), file)
-        self.console.print(table)
+        table.add_column("Size", justify="right")
+        table.add_column("Modified", justify="left")
+        for i, entry in enumerate(shown, first + 1):
+            stats = entry_stat(entry)
+            is_dir = entry.is_dir()
+            modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(stats.st_mtime)) if stats else "-"
+            size = str(stats.st_size) if stats and not is_dir else "-"
+            table.add_row(str(i), entry.name + "/" if is_dir else entry.name, size, modified)
+        self.print_table(table)
+        if not show_all and page < pages:
+            self.console.print(f"[dim]Page {page} of {pages}, {len(entries)} entries: list:{sort_by} {page + 1} for the next page, "
+                               f"list:{sort_by} all for everything[/dim]")
 
     def show_path(self):
         self.console.print(f"[bold yellow]Current Path:[/bold yellow] {self.current_path}")
 
-    def show_file_contents(self, filename):
-        if os.path.exists(filename):
-            with open(filename, 'r') as file:
-                contents = file.read()
-            lexer = lexers.guess_lexer_for_filename(filename, contents)
-            syntax = Syntax(contents, lexer.name, theme="monokai", line_numbers=True)
-            self.console.print(syntax)
-        else:
-            self.console.print(f"[bold red]Error:[/bold red] File not found.")
+    def show_file_contents(self, filename, line=1):
+        """Show one page of a file from line on, highlighting just that page."""
+        if not os.path.exists(filename):
+            self.error("File not found.")
+            return
+        with MappedFile(filename) as mapped:
+            lines = mapped.lines(line - 1, self.page_lines + 1)
+            if not lines:
+                if mapped.size:
+                    self.error(f"{filename} has fewer than {line} lines.")
+                return
+            more = len(lines) > self.page_lines
+            self.show_lines(mapped, line, lines[:self.page_lines])
+        if more:
+            next_line = line + self.page_lines
+            self.console.print(f"[dim]More below: contents:{filename} at {next_line}[/dim]")
+
+    def show_lines(self, mapped, first_line, lines):
+        from rich.syntax import Syntax
+        syntax = Syntax("\n".join(lines), mapped.lexer(), theme="monokai",
+                        line_numbers=True, start_line=first_line)
+        self.console.print(syntax)
+
+    def tail_file(self, filename, count=20):
+        if not os.path.exists(filename):
+            self.error("File not found.")
+            return
+        with MappedFile(filename) as mapped:
+            first_line, lines = mapped.tail(count)
+            if lines:
+                self.show_lines(mapped, first_line, lines)
+
+    def follow_file(self, filename, interval=0.5):
+        """Show the end of a file, then print lines as they are appended until Ctrl+C."""
+        if not os.path.exists(filename):
+            self.error("File not found.")
+            return
+        self.tail_file(filename)
+        self.console.print(f"[dim]Following {filename}, press Ctrl+C to stop.[/dim]")
+        with open(filename, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            partial = b""
+            try:
+                while True:
+                    data = file.read()
+                    if not data:
+                        if os.fstat(file.fileno()).st_size < file.tell():
+                            # Truncated, as log rotation does; start again from the top
+                            file.seek(0)
+                            partial = b""
+                        time.sleep(interval)
+                        continue
+                    *lines, partial = (partial + data).split(b"\n")
+                    for line in lines:
+                        self.console.print(line.decode("utf-8", "replace").rstrip("\r"), markup=False, highlight=False)
+            except KeyboardInterrupt:
+                self.console.print()
 
     def show_file_stat(self, filename):
-        if os.path.exists(filename):
-            stats = os.stat(filename)
-            table = Table(title=f"Stats for {filename}", style="magenta")
-            table.add_column("Property", justify="left")
-            table.add_column("Value", justify="right")
-
-            table.add_row("Size", str(stats.st_size))
-            table.add_row("Created", time.ctime(stats.st_ctime))
-            table.add_row("Modified", time.ctime(stats.st_mtime))
-            table.add_row("Accessed", time.ctime(stats.st_atime))
-            self.console.print(table)
-        else:
-            self.console.print(f"[bold red]Error:[/bold red] File not found.")
+        from rich.table import Table
+        try:
+            with timings.span("fs", "stat"):
+                stats = os.stat(filename)
+        except FileNotFoundError:
+            self.error("File not found.")
+            return
+        table = Table(title=f"Stats for {filename}", style="magenta")
+        table.add_column("Property", justify="left")
+        table.add_column("Value", justify="right")
+
+        table.add_row("Size", str(stats.st_size))
+        table.add_row("Created", time.ctime(stats.st_ctime))
+        table.add_row("Modified", time.ctime(stats.st_mtime))
+        table.add_row("Accessed", time.ctime(stats.st_atime))
+        self.print_table(table)
 
     def show_file_size(self, filename):
-        if os.path.exists(filename):
+        try:
             size = os.path.getsize(filename)
-            self.console.print(f"[bold green]File Size:[/bold green] {size} bytes")
-        else:
-            self.console.print(f"[bold red]Error:[/bold red] File not found.")
+        except FileNotFoundError:
+            self.error("File not found.")
+            return
+        self.console.print(f"[bold green]File Size:[/bold green] {size} bytes")
 
     def create_file(self, filename):
         if not os.path.exists(filename):
-            with open(filename, 'w') as file:
+            with timings.span("fs", "create"), open(filename, 'w') as file:
                 file.write('')
             self.console.print(f"[bold green]File '{filename}' created successfully.[/bold green]")
         else:
-            self.console.print(f"[bold red]Error:[/bold red] File already exists.")
+            self.error("File already exists.")
 
     def delete_file(self, filename):
         if os.path.exists(filename):
-            os.remove(filename)
+            with timings.span("fs", "remove"):
+                os.remove(filename)
             self.console.print(f"[bold green]File '{filename}' deleted successfully.[/bold green]")
         else:
-            self.console.print(f"[bold red]Error:[/bold red] File not found.")
+            self.error("File not found.")
 
     def rename_file(self, old_name, new_name):
         if os.path.exists(old_name):
-            os.rename(old_name, new_name)
+            with timings.span("fs", "rename"):
+                os.rename(old_name, new_name)
             self.console.print(f"[bold green]File renamed from '{old_name}' to '{new_name}'[/bold green]")
         else:
-            self.console.print(f"[bold red]Error:[/bold red] File not found.")
+            self.error("File not found.")
 
-    def copy_file(self, source, destination):
-        if os.path.exists(source):
-            shutil.copy(source, destination)
-            self.console.print(f"[bold green]File '{source}' copied to '{destination}'[/bold green]")
-        else:
-            self.console.print(f"[bold red]Error:[/bold red] Source file not found.")
+    def copy_file(self, source, destination, options=()):
+        self.transfer(source, destination, options)
 
-    def move_file(self, source, destination):
-        if os.path.exists(source):
-            shutil.move(source, destination)
-            self.console.print(f"[bold green]File '{source}' moved to '{destination}'[/bold green]")
-        else:
-            self.console.print(f"[bold red]Error:[/bold red] Source file not found.")
-
-    def search_files(self, keyword):
-        files = [f for f in os.listdir(self.current_path) if keyword.lower() in f.lower()]
-        if files:
-            self.console.print("[bold cyan]Found Files:[/bold cyan]")
-            for file in files:
-                self.console.print(file)
+    def move_file(self, source, destination, options=()):
+        self.transfer(source, destination, options, move=True)
+
+    def transfer(self, source, destination, options=(), move=False):
+        """Copy or move files, globs and directory trees on a thread pool, with a progress bar.
+
+        With 'resume', files that were already copied (same size and mtime)
+        are skipped and shorter ones carry on from where they stopped. With
+        'verify', each copy's checksum is checked against its source.
+        """
+        import errno
+        import shutil
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from rich.progress import (TextColumn, BarColumn, DownloadColumn,
+                                   TransferSpeedColumn, TimeRemainingColumn)
+        unknown = set(options) - {"resume", "verify"}
+        if unknown:
+            self.error(f"Unknown option: {', '.join(sorted(unknown))}.")
+            return
+        started = time.perf_counter()
+        pairs = transfer_pairs(source, destination)
+        renamed = 0
+        if move:
+            # Within one filesystem a rename moves a whole tree at once; only
+            # moves across filesystems are copied and then deleted
+            remaining = []
+            for path, target in pairs:
+                try:
+                    os.rename(path, target)
+                    renamed += 1
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    remaining.append((path, target))
+            pairs = remaining
+        directories, jobs = [], []
+        for path, target in pairs:
+            pair_directories, pair_jobs = tree_jobs(path, target)
+            directories.extend(pair_directories)
+            jobs.extend(pair_jobs)
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+
+        columns = (TextColumn("{task.description}"), BarColumn(), DownloadColumn(),
+                   TransferSpeedColumn(), TimeRemainingColumn())
+        total = sum(size or 0 for _, _, size in jobs)
+        failures = []
+        with self.progress(*columns) as progress:
+            task = progress.add_task("Moving" if move else "Copying", total=total)
+
+            def copy_one(job):
+                path, target, size = job
+                if size is None:
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(os.readlink(path), target)
+                    return
+                check_not_same(path, target)
+                offset = 0
+                if "resume" in options and os.path.exists(target):
+                    stats, copied = os.stat(path), os.stat(target)
+                    if copied.st_size == stats.st_size and copied.st_mtime_ns == stats.st_mtime_ns:
+                        progress.advance(task, size)
+                        return
+                    if copied.st_size < stats.st_size:
+                        offset = copied.st_size
+                        progress.advance(task, offset)
+                copy_data(path, target, offset, lambda sent: progress.advance(task, sent))
+                # Copying the mtime last is what marks the file as complete for 'resume'
+                shutil.copystat(path, target)
+                if "verify" in options and file_digest(path) != file_digest(target):
+                    raise OSError(f"Checksum mismatch for '{target}'.")
+
+            with ThreadPoolExecutor(max_workers=min(8, len(jobs) or 1)) as pool:
+                futures = {pool.submit(copy_one, job): job for job in jobs}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except OSError as e:
+                        failures.append((futures[future][0], e))
+
+        if failures:
+            self.error(f"{len(failures)} of {len(jobs)} files failed to {'move' if move else 'copy'}.")
+            for path, e in failures[:10]:
+                self.console.print(f"  {path}: {e}", markup=False)
+            return
+        if move:
+            for path, _ in pairs:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        elapsed = time.perf_counter() - started
+        summary = f"{len(jobs)} file{'' if len(jobs) == 1 else 's'} ({format_size(total)})"
+        if renamed:
+            summary = f"{renamed} renamed, {summary} copied" if jobs else f"{renamed} renamed"
+        verb = "moved" if move else "copied"
+        self.console.print(f"[bold green]'{source}' {verb} to '{destination}': {summary} in {elapsed:.2f}s[/bold green]")
+
+    def progress(self, *columns):
+        # Progress is drawn only on a terminal and cleared when done, so scripts and JSON output stay clean
+        from rich.progress import Progress
+        return Progress(*columns, console=self.console, transient=True, disable=not self.console.is_terminal)
+
+    def disk_usage(self, path, top=10, output=None):
+        """Show the largest directories (with everything under them) and files in a tree."""
+        import heapq
+        from rich.progress import SpinnerColumn, TextColumn
+        from rich.table import Table
+        if not os.path.isdir(path):
+            self.error("Directory not found.")
+            return
+        # Cached listings can carry stale sizes, so every directory is listed again
+        index = DirectoryIndex(path, fresh=True)
+        totals, counts, largest = {}, {}, []
+        scanned = 0
+        with self.progress(SpinnerColumn(), TextColumn("{task.description}")) as progress:
+            task = progress.add_task("Scanning")
+            for directory, entries in index.walk():
+                size = count = 0
+                for name, is_dir, entry_size, _ in entries:
+                    if is_dir:
+                        continue
+                    size += entry_size
+                    count += 1
+                    if len(largest) < top:
+                        heapq.heappush(largest, (entry_size, directory, name))
+                    elif entry_size > largest[0][0]:
+                        heapq.heapreplace(largest, (entry_size, directory, name))
+                totals[directory], counts[directory] = size, count
+                scanned += size
+                progress.update(task, description=f"Scanning: {len(totals)} directories, {format_size(scanned)}")
+        index.save()
+        # Deepest directories first, so each one is complete before it is added to its parent
+        for directory in sorted(totals, key=lambda directory: directory.count(os.sep), reverse=True):
+            parent = os.path.dirname(directory)
+            if directory != index.root and parent in totals:
+                totals[parent] += totals[directory]
+                counts[parent] += counts[directory]
+
+        directories = heapq.nlargest(top, totals, key=totals.get)
+        files = sorted(largest, reverse=True)
+        table = Table(title=f"Largest Directories in {path}", style="cyan")
+        table.add_column("Directory", justify="left")
+        table.add_column("Size", justify="right")
+        table.add_column("Files", justify="right")
+        for directory in directories:
+            table.add_row(os.path.relpath(directory, index.root), format_size(totals[directory]), str(counts[directory]))
+        self.print_table(table)
+        table = Table(title=f"Largest Files in {path}", style="cyan")
+        table.add_column("File", justify="left")
+        table.add_column("Size", justify="right")
+        for size, directory, name in files:
+            table.add_row(os.path.relpath(os.path.join(directory, name), index.root), format_size(size))
+        self.print_table(table)
+        self.console.print(f"[bold green]Total:[/bold green] {format_size(totals[index.root])} in "
+                           f"{counts[index.root]} files and {len(totals)} directories")
+        if output:
+            rows = [{"type": "directory", "path": directory, "size": totals[directory], "files": counts[directory]}
+                    for directory in sorted(totals)]
+            rows += [{"type": "file", "path": os.path.join(directory, name), "size": size, "files": 1}
+                     for size, directory, name in files]
+            write_rows(output, rows)
+            self.console.print(f"[bold green]Results written to {output}[/bold green]")
+
+    def find_duplicates(self, path, output=None, shown=20):
+        """Find files with identical contents: grouped by size, then by a hash of their first block, then in full."""
+        from rich.progress import BarColumn, DownloadColumn, SpinnerColumn, TextColumn, TransferSpeedColumn
+        from rich.table import Table
+        if not os.path.isdir(path):
+            self.error("Directory not found.")
+            return
+        index = DirectoryIndex(path, fresh=True)
+        by_size = {}
+        with self.progress(SpinnerColumn(), TextColumn("{task.description}")) as progress:
+            task = progress.add_task("Scanning")
+            for directory, entries in index.walk():
+                for name, is_dir, size, _ in entries:
+                    if not is_dir and size:
+                        by_size.setdefault(size, []).append(os.path.join(directory, name))
+                progress.update(task, description=f"Scanning: {sum(map(len, by_size.values()))} files")
+        index.save()
+        # Links would show up as copies of their targets
+        groups = [(size, [path for path in paths if not os.path.islink(path)])
+                  for size, paths in by_size.items() if len(paths) > 1]
+        groups = [(size, paths) for size, paths in groups if len(paths) > 1]
+
+        block = 1 << 16
+        columns = (TextColumn("{task.description}"), BarColumn(), DownloadColumn(), TransferSpeedColumn())
+        with self.progress(*columns) as progress:
+            task = progress.add_task("Hashing first blocks",
+                                     total=sum(min(size, block) * len(paths) for size, paths in groups))
+            groups = regroup(groups, lambda path: partial_digest(path, block),
+                             lambda size: progress.advance(task, min(size, block)))
+            # Files no bigger than the first block have already been hashed in full
+            complete = [group for group in groups if group[0] <= block]
+            groups = [group for group in groups if group[0] > block]
+            task = progress.add_task("Hashing files", total=sum(size * len(paths) for size, paths in groups))
+            groups = complete + regroup(groups, file_digest, lambda size: progress.advance(task, size))
+
+        groups.sort(key=lambda group: group[0] * (len(group[1]) - 1), reverse=True)
+        table = Table(title=f"Duplicate Files in {path}", style="cyan")
+        table.add_column("Group", justify="right")
+        table.add_column("Size", justify="right")
+        table.add_column("File", justify="left")
+        for number, (size, paths) in enumerate(groups[:shown], 1):
+            for path_in_group in sorted(paths):
+                table.add_row(str(number), format_size(size), os.path.relpath(path_in_group, index.root))
+        if groups:
+            self.print_table(table)
+        if len(groups) > shown:
+            self.console.print(f"[dim]{len(groups) - shown} more groups not shown.[/dim]")
+        wasted = sum(size * (len(paths) - 1) for size, paths in groups)
+        duplicates = sum(len(paths) - 1 for _, paths in groups)
+        self.console.print(f"[bold green]{len(groups)} groups, {duplicates} duplicate files, "
+                           f"{format_size(wasted)} reclaimable[/bold green]")
+        if output:
+            write_rows(output, [{"group": number, "size": size, "path": path_in_group}
+                                for number, (size, paths) in enumerate(groups, 1) for path_in_group in sorted(paths)])
+            self.console.print(f"[bold green]Results written to {output}[/bold green]")
+
+    def search_files(self, query):
+        import re
+        from concurrent.futures import ThreadPoolExecutor
+        pattern, _, content = query.partition(" containing ")
+        try:
+            matches = name_matcher(pattern.strip())
+            content_regex = None
+            if content.strip():
+                content = content.strip()
+                content_regex = re.compile(content[3:].encode() if content.startswith("re:") else re.escape(content.encode()))
+        except re.error as e:
+            self.error(f"Invalid pattern: {e}")
+            return
+
+        found = 0
+        index = DirectoryIndex(self.current_path)
+
+        def show(path, is_dir=False):
+            self.console.print(os.path.relpath(path, self.current_path) + (os.sep if is_dir else ""),
+                               markup=False, highlight=False)
+
+        def show_grep(future):
+            path, lines = future.result()
+            for number, line in lines:
+                self.console.print(f"[cyan]{os.path.relpath(path, self.current_path)}:{number}:[/cyan] ", end="")
+                self.console.print(line, markup=False, highlight=False)
+            return 1 if lines else 0
+
+        self.console.print(f"[bold cyan]Searching {self.current_path}...[/bold cyan]")
+        with ThreadPoolExecutor() as grep_pool:
+            greps = []
+            # Print results as they turn up rather than after the whole tree has been walked
+            for directory, entries in index.walk():
+                for name, is_dir, _, _ in entries:
+                    if not matches(name):
+                        continue
+                    path = os.path.join(directory, name)
+                    if content_regex is None:
+                        show(path, is_dir)
+                        found += 1
+                    elif not is_dir:
+                        greps.append(grep_pool.submit(lambda path=path: (path, grep_file(path, content_regex))))
+                finished = [future for future in greps if future.done()]
+                greps = [future for future in greps if not future.done()]
+                found += sum(show_grep(future) for future in finished)
+            found += sum(show_grep(future) for future in greps)
+        try:
+            index.save()
+        except OSError:
+            pass
+
+        summary = f"{len(index.dirs)} directories searched, {index.listed} re-listed"
+        if found:
+            self.console.print(f"[bold cyan]Found {found} {'files' if content_regex is None else 'files with matches'}[/bold cyan] ({summary})")
         else:
-            self.console.print(f"[bold red]No files found with '{keyword}'[/bold red]")
+            self.console.print(f"[bold red]No files found with '{query}'[/bold red] ({summary})")
 
     def preview_file(self, filename, num_lines=10):
         if os.path.exists(filename):
-            with open(filename, 'r') as file:
-                preview = ''.join([file.readline() for _ in range(num_lines)])
+            with MappedFile(filename) as mapped:
+                preview = mapped.lines(0, num_lines)
             self.console.print(f"[bold yellow]Preview of {filename}:[/bold yellow]")
-            self.console.print(preview)
+            self.console.print("\n".join(preview), markup=False)
         else:
-            self.console.print(f"[bold red]Error:[/bold red] File not found.")
+            self.error("File not found.")
 
     def compare_files(self, file1, file2):
-        if os.path.exists(file1) and os.path.exists(file2):
-            with open(file1, 'r') as f1, open(file2, 'r') as f2:
-                diff = difflib.unified_diff(f1.readlines(), f2.readlines(), fromfile=file1, tofile=file2)
-                self.console.print("[bold cyan]File Comparison:[/bold cyan]")
-                self.console.print(''.join(diff))
+        if not (os.path.exists(file1) and os.path.exists(file2)):
+            self.error("One or both files not found.")
+            return
+        self.console.print("[bold cyan]File Comparison:[/bold cyan]")
+        if same_contents(file1, file2):
+            self.console.print("[bold green]Files are identical.[/bold green]")
+        elif looks_binary(file1) or looks_binary(file2):
+            self.compare_binary_files(file1, file2)
         else:
-            self.console.print(f"[bold red]Error:[/bold red] One or both files not found.")
+            self.compare_text_files(file1, file2)
+
+    def compare_text_files(self, file1, file2):
+        from rich.text import Text
+        # Lines are matched by hash and only the lines in each hunk are read back
+        # for display, so hunks print as they are found
+        added = removed = hunks = 0
+        self.console.print(f"--- {file1}\n+++ {file2}", style="bold", markup=False, highlight=False)
+        with MappedFile(file1) as mapped1, MappedFile(file2) as mapped2:
+            for hunk in diff_hunks(line_hashes(file1), line_hashes(file2)):
+                _, i1, _, j1, _ = hunk[0]
+                _, _, i2, _, j2 = hunk[-1]
+                text = Text(f"@@ -{hunk_range(i1, i2)} +{hunk_range(j1, j2)} @@\n", style="cyan")
+                for tag, i1, i2, j1, j2 in hunk:
+                    if tag == "equal":
+                        for line in mapped1.lines(i1, i2 - i1):
+                            text.append(f" {line}\n")
+                        continue
+                    for line in mapped1.lines(i1, i2 - i1):
+                        text.append(f"-{line}\n", style="red")
+                    for line in mapped2.lines(j1, j2 - j1):
+                        text.append(f"+{line}\n", style="green")
+                    removed += i2 - i1
+                    added += j2 - j1
+                self.console.print(text, end="")
+                hunks += 1
+        self.console.print(f"[bold]{hunks} hunks, {added} lines added, {removed} lines removed[/bold]")
+
+    def compare_binary_files(self, file1, file2, max_ranges=50):
+        from rich.table import Table
+        table = Table(title="Differing Byte Ranges", style="cyan")
+        table.add_column("Start", justify="right")
+        table.add_column("End", justify="right")
+        table.add_column("Bytes", justify="right")
+        total = count = 0
+        for start, end in differing_ranges(file1, file2):
+            if count < max_ranges:
+                table.add_row(f"0x{start:x}", f"0x{end:x}", str(end - start))
+            total += end - start
+            count += 1
+        if count:
+            self.print_table(table)
+        if count > max_ranges:
+            self.console.print(f"[dim]{count - max_ranges} more ranges not shown.[/dim]")
+        self.console.print(f"[bold]{count} differing ranges, {total} bytes differ[/bold]")
+        size1, size2 = os.path.getsize(file1), os.path.getsize(file2)
+        if size1 != size2:
+            self.console.print(f"[bold yellow]Sizes differ:[/bold yellow] {file1} is {size1} bytes, {file2} is {size2} bytes")
 
     def change_directory(self, path):
         if os.path.exists(path) and os.path.isdir(path):
@@ -140,17 +1241,26 @@ class BookLAB:
             self.current_path = os.getcwd()
             self.console.print(f"[bold green]Directory changed to {self.current_path}[/bold green]")
         else:
-            self.console.print(f"[bold red]Error:[/bold red] Invalid directory path.")
+            self.error("Invalid directory path.")
 
     def list_directories(self):
-        dirs = [d for d in os.listdir(self.current_path) if os.path.isdir(os.path.join(self.current_path, d))]
+        dirs = [entry.name for entry in self.sorted_entries(self.current_path, "name") if entry.is_dir()]
         if dirs:
             self.console.print("[bold cyan]Directories in Current Path:[/bold cyan]")
-            for d in dirs:
-                self.console.print(d)
+            self.console.print("\n".join(dirs), markup=False, highlight=False)
         else:
             self.console.print(f"[bold red]No directories found.[/bold red]")
 
+    def show_stats(self):
+        table = timings.summary_table(format_ms)
+        if table is None:
+            self.console.print("[bold yellow]No timings recorded yet.[/bold yellow]")
+        else:
+            self.print_table(table)
+
+    def export_stats(self, path, trace=False):
+        self.console.print(timings.export_report(path, trace))
+
     def show_system_info(self):
         import platform
         self.console.print(f"[bold yellow]System Information:[/bold yellow]")
@@ -159,96 +1269,243 @@ class BookLAB:
         self.console.print(f"Processor: {platform.processor()}")
         self.console.print(f"Python Version: {platform.python_version()}")
 
+    def error(self, message):
+        self.failed = True
+        self.console.print(f"[bold red]Error:[/bold red] {message}")
+
+    def print_table(self, table):
+        # In JSON mode tables are reported as data rather than drawn
+        if self.tables is None:
+            self.console.print(table)
+        else:
+            columns = [str(column.header) for column in table.columns]
+            rows = zip(*(list(column.cells) for column in table.columns))
+            self.tables.append({
+                'title': str(table.title) if table.title else None,
+                'rows': [dict(zip(columns, map(str, row))) for row in rows],
+            })
+
     def start(self):
+        from rich.panel import Panel
         while True:
             self.console.clear()
             self.console.print(Panel("Welcome to BookLAB! Type 'help' for commands.", style="bold cyan"))
             cell_number = 1
             while True:
                 command = self.display_prompt(cell_number)
-                if command.startswith("list:"):
-                    self.list_files()
-                elif command.startswith("path:"):
-                    self.show_path()
-                elif command.startswith("contents:"):
-                    filename = command[len("contents:"):].strip()
-                    self.show_file_contents(filename)
-                elif command.startswith("stat:"):
-                    filename = command[len("stat:"):].strip()
-                    self.show_file_stat(filename)
-                elif command.startswith("size:"):
-                    filename = command[len("size:"):].strip()
-                    self.show_file_size(filename)
-                elif command.startswith("create:"):
-                    filename = command[len("create:"):].strip()
-                    self.create_file(filename)
-                elif command.startswith("delete:"):
-                    filename = command[len("delete:"):].strip()
-                    self.delete_file(filename)
-                elif command.startswith("rename:"):
-                    parts = command[len("rename:"):].strip().split(" to ")
-                    if len(parts) == 2:
-                        self.rename_file(parts[0], parts[1])
-                    else:
-                        self.console.print("[bold red]Error:[/bold red] Invalid syntax.")
-                elif command.startswith("copy:"):
-                    parts = command[len("copy:"):].strip().split(" to ")
-                    if len(parts) == 2:
-                        self.copy_file(parts[0], parts[1])
-                    else:
-                        self.console.print("[bold red]Error:[/bold red] Invalid syntax.")
-                elif command.startswith("move:"):
-                    parts = command[len("move:"):].strip().split(" to ")
-                    if len(parts) == 2:
-                        self.move_file(parts[0], parts[1])
-                    else:
-                        self.console.print("[bold red]Error:[/bold red] Invalid syntax.")
-                elif command.startswith("search:"):
-                    keyword = command[len("search:"):].strip()
-                    self.search_files(keyword)
-                elif command.startswith("preview:"):
-                    filename = command[len("preview:"):].strip()
-                    self.preview_file(filename)
-                elif command.startswith("compare:"):
-                    files = command[len("compare:"):].strip().split(" and ")
-                    if len(files) == 2:
-                        self.compare_files(files[0], files[1])
-                    else:
-                        self.console.print("[bold red]Error:[/bold red] Invalid syntax.")
-                elif command.startswith("cd:"):
-                    path = command[len("cd:"):].strip()
-                    self.change_directory(path)
-                elif command == "dirs":
-                    self.list_directories()
-                elif command == "sysinfo":
-                    self.show_system_info()
-                elif command == "exit":
+                if not self.run_command(command):
                     sys.exit()
-                elif command == "help":
-                    self.console.print("[bold yellow]Commands:[/bold yellow]")
-                    self.console.print("- list:       List available files")
-                    self.console.print("- path:       Show current directory path")
-                    self.console.print("- contents:<filename>    Show file contents with syntax highlight")
-                    self.console.print("- stat:<filename>        Show file stats")
-                    self.console.print("- size:<filename>        Show file size")
-                    self.console.print("- create:<filename>      Create a new file")
-                    self.console.print("- delete:<filename>      Delete a file")
-                    self.console.print("- rename:<old> to <new>  Rename a file")
-                    self.console.print("- copy:<source> to <dest>    Copy a file")
-                    self.console.print("- move:<source> to <dest>    Move a file")
-                    self.console.print("- search:<keyword>       Search files by keyword")
-                    self.console.print("- preview:<filename>     Preview the first few lines of a file")
-                    self.console.print("- compare:<file1> and <file2>  Compare two files")
-                    self.console.print("- cd:<path>              Change directory")
-                    self.console.print("- dirs                   List directories in current path")
-                    self.console.print("- sysinfo                Show system information")
-                    self.console.print("- exit                   Exit BookLAB")
-                else:
-                    self.console.print(f"[bold red]Error:[/bold red] Unknown command.")
                 time.sleep(1)
                 cell_number += 1
 
+    def run_script(self, commands, json_output=False, stop_on_error=False):
+        """Run commands without prompts, pauses or screen clears.
+
+        Blank lines and lines starting with '#' are skipped. With json_output
+        each command's result is written to stdout as one JSON object per line
+        instead of rich output. Returns 1 if any command failed, else 0.
+        """
+        import json
+        from io import StringIO
+        status = 0
+        for cell_number, line in enumerate(commands, 1):
+            command = line.strip()
+            if not command or command.startswith('#'):
+                continue
+            self.failed = False
+            if json_output:
+                buffer = StringIO()
+                self.console = timed_console(file=buffer, width=120, no_color=True)
+                self.tables = []
+            else:
+                self.console.print(f"[bold green]Cell {cell_number}:[/bold green] {command}")
+            keep_going = self.run_command(command)
+            if json_output:
+                record = {'cell': cell_number, 'command': command, 'ok': not self.failed,
+                          'output': buffer.getvalue(), 'tables': self.tables}
+                sys.stdout.write(json.dumps(record) + '\n')
+                sys.stdout.flush()
+            if self.failed:
+                status = 1
+                if stop_on_error:
+                    break
+            if not keep_going:
+                break
+        return status
+
+    def run_command(self, command):
+        """Run one command; returns False when the command asks BookLAB to exit."""
+        # 'list:size 2' is timed as 'list', 'dirs' as 'dirs'
+        name = command.strip().partition(":")[0].split(" ")[0] or "empty"
+        with timings.span("command", name, process_cpu=True):
+            try:
+                return self.dispatch(command)
+            except OSError as e:
+                self.error(str(e))
+                return True
+
+    def dispatch(self, command):
+        if command.startswith("list:"):
+            sort_by, page, show_all = "name", 1, False
+            for word in command[len("list:"):].split():
+                if word in ("name", "size", "mtime"):
+                    sort_by = word
+                elif word == "all":
+                    show_all = True
+                elif word.isdigit() and int(word) > 0:
+                    page = int(word)
+                else:
+                    self.error("Invalid syntax.")
+                    return True
+            self.list_files(sort_by, page, show_all)
+        elif command.startswith("path:"):
+            self.show_path()
+        elif command.startswith("contents:"):
+            filename, _, line = command[len("contents:"):].strip().partition(" at ")
+            if not line:
+                self.show_file_contents(filename)
+            elif line.strip().isdigit() and int(line) > 0:
+                self.show_file_contents(filename, int(line))
+            else:
+                self.error("Invalid line number.")
+        elif command.startswith("tail:"):
+            filename, _, count = command[len("tail:"):].strip().partition(" last ")
+            if not count:
+                self.tail_file(filename)
+            elif count.strip().isdigit():
+                self.tail_file(filename, int(count))
+            else:
+                self.error("Invalid line count.")
+        elif command.startswith("follow:"):
+            filename = command[len("follow:"):].strip()
+            self.follow_file(filename)
+        elif command.startswith("stat:"):
+            filename = command[len("stat:"):].strip()
+            self.show_file_stat(filename)
+        elif command.startswith("size:"):
+            filename = command[len("size:"):].strip()
+            self.show_file_size(filename)
+        elif command.startswith("create:"):
+            filename = command[len("create:"):].strip()
+            self.create_file(filename)
+        elif command.startswith("delete:"):
+            filename = command[len("delete:"):].strip()
+            self.delete_file(filename)
+        elif command.startswith("rename:"):
+            parts = command[len("rename:"):].strip().split(" to ")
+            if len(parts) == 2:
+                self.rename_file(parts[0], parts[1])
+            else:
+                self.error("Invalid syntax.")
+        elif command.startswith("copy:"):
+            parts = command[len("copy:"):].strip().split(" to ")
+            if len(parts) == 2:
+                destination, _, options = parts[1].partition(" with ")
+                self.copy_file(parts[0], destination.strip(), options.replace(",", " ").split())
+            else:
+                self.error("Invalid syntax.")
+        elif command.startswith("move:"):
+            parts = command[len("move:"):].strip().split(" to ")
+            if len(parts) == 2:
+                destination, _, options = parts[1].partition(" with ")
+                self.move_file(parts[0], destination.strip(), options.replace(",", " ").split())
+            else:
+                self.error("Invalid syntax.")
+        elif command.startswith("search:"):
+            keyword = command[len("search:"):].strip()
+            self.search_files(keyword)
+        elif command.startswith("du:"):
+            rest, _, output = command[len("du:"):].partition(" to ")
+            path, _, top = rest.partition(" top ")
+            if top and not top.strip().isdigit():
+                self.error("Invalid syntax.")
+            else:
+                self.disk_usage(path.strip() or ".", int(top) if top else 10, output.strip() or None)
+        elif command.startswith("dupes:"):
+            path, _, output = command[len("dupes:"):].partition(" to ")
+            self.find_duplicates(path.strip() or ".", output.strip() or None)
+        elif command.startswith("preview:"):
+            filename = command[len("preview:"):].strip()
+            self.preview_file(filename)
+        elif command.startswith("compare:"):
+            files = command[len("compare:"):].strip().split(" and ")
+            if len(files) == 2:
+                self.compare_files(files[0], files[1])
+            else:
+                self.error("Invalid syntax.")
+        elif command.startswith("cd:"):
+            path = command[len("cd:"):].strip()
+            self.change_directory(path)
+        elif command == "dirs":
+            self.list_directories()
+        elif command == "sysinfo":
+            self.show_system_info()
+        elif command in ("stats", "stats:"):
+            self.show_stats()
+        elif command.startswith("stats:"):
+            mode, _, path = command[len("stats:"):].strip().partition(" ")
+            if mode == "clear":
+                timings.clear()
+                self.console.print("[bold green]Timings cleared.[/bold green]")
+            elif mode in ("export", "trace") and path.strip():
+                self.export_stats(path.strip(), trace=mode == "trace")
+            else:
+                self.error("Invalid syntax.")
+        elif command == "exit":
+            return False
+        elif command == "help":
+            self.console.print("[bold yellow]Commands:[/bold yellow]")
+            self.console.print("- list:[name|size|mtime] [<page>|all]  List files a page at a time, sorted")
+            self.console.print("- path:       Show current directory path")
+            self.console.print("- contents:<filename> [at <line>]  Show a page of a file with syntax highlight")
+            self.console.print("- tail:<filename> [last <n>]     Show the last lines of a file")
+            self.console.print("- follow:<filename>      Show lines as they are appended to a file (Ctrl+C stops)")
+            self.console.print("- stat:<filename>        Show file stats")
+            self.console.print("- size:<filename>        Show file size")
+            self.console.print("- create:<filename>      Create a new file")
+            self.console.print("- delete:<filename>      Delete a file")
+            self.console.print("- rename:<old> to <new>  Rename a file")
+            self.console.print("- copy:<source> to <dest> [with resume, verify]  Copy files, globs or directories")
+            self.console.print("- move:<source> to <dest> [with resume, verify]  Move files, globs or directories")
+            self.console.print("- search:<pattern> [containing <text>]  Search the tree by name (substring, glob or re:<regex>)")
+            self.console.print("                         and optionally by content (text or re:<regex>)")
+            self.console.print("- du:<path> [top <n>] [to <file.csv|json>]  Largest directories and files under a path")
+            self.console.print("- dupes:<path> [to <file.csv|json>]        Find files with identical contents")
+            self.console.print("- preview:<filename>     Preview the first few lines of a file")
+            self.console.print("- compare:<file1> and <file2>  Compare two files")
+            self.console.print("- cd:<path>              Change directory")
+            self.console.print("- dirs                   List directories in current path")
+            self.console.print("- sysinfo                Show system information")
+            self.console.print("- stats:                 Timing percentiles for commands, filesystem operations and rendering")
+            self.console.print("- stats:export <file.json> | stats:trace <file.json> | stats:clear")
+            self.console.print("                         Save the timings as JSON or a Chrome trace, or reset them")
+            self.console.print("- exit                   Exit BookLAB")
+        else:
+            self.error("Unknown command.")
+        return True
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="BookLAB terminal file notebook.")
+    parser.add_argument("--script", metavar="FILE",
+                        help="run the commands in FILE ('-' for stdin) without prompts or pauses")
+    parser.add_argument("--json", action="store_true",
+                        help="in script mode, print one JSON object per command instead of rich output")
+    parser.add_argument("--stop-on-error", action="store_true",
+                        help="in script mode, stop at the first command that fails")
+    args = parser.parse_args(argv)
 
-if __name__ == "__main__":
     lab = BookLAB()
-    lab.start()
+    if args.script is None and sys.stdin.isatty():
+        lab.start()
+        return 0
+    # Commands piped in on stdin run as a script too
+    if args.script in (None, '-'):
+        return lab.run_script(sys.stdin, args.json, args.stop_on_error)
+    with open(args.script, 'r') as script:
+        return lab.run_script(script, args.json, args.stop_on_error)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,38 +1,1125 @@
 import os
 import sys
+import ast
+import json
+import zlib
+import struct
+import marshal
+import threading
+import time
+import codecs
+import signal
+import builtins
+import linecache
+import selectors
+import traceback
 import subprocess
-from rich.console import Console
-from rich.prompt import Prompt
-from rich.syntax import Syntax
-from rich.panel import Panel
-from rich.tree import Tree
-import autopep8
-import cProfile
-import pstats
-from io import StringIO
-
-console = Console()
-
-# Store code and output for saving later
+from collections import Counter, OrderedDict
+from telemetry import Telemetry
+
+
+class LazyConsole:
+    # rich and its dependencies are only imported once something is printed, so
+    # the kernel process and scripts importing this module start quickly
+    def __init__(self):
+        self.console = None
+
+    def __getattr__(self, name):
+        global console
+        if self.console is None:
+            from rich.console import Console
+            self.console = Console()
+            self.console.print = timings.timed('render', 'print')(self.console.print)
+        console = self.console
+        return getattr(self.console, name)
+
+
+console = LazyConsole()
+
+# Wall and CPU time of commands, formatting, subprocesses and rendering, kept for stats:
+timings = Telemetry(capacity=10_000)
+
+# Store every cell, in the order cells were first run, for re-running and saving later
 code_output_log = []
 
-def execute_code_in_file(filename, code):
+# Cells run in a persistent kernel process by default; cells that run without an
+# error are still appended to the script file, so it remains a runnable export.
+use_kernel = os.name == 'posix'
+
+# Per-cell wall-clock limit in seconds (None for no limit), and how long an
+# interrupted cell gets to stop before its process is killed.
+cell_timeout = None
+interrupt_grace = 5
+
+# Output beyond this many characters per cell is kept on disk instead of in code_output_log
+max_output_chars = 100_000
+output_spill_dir = '.pybook_outputs'
+
+# autopep8 results are memoised by a hash of the source and options, in memory and
+# optionally on disk (set format_cache_dir to None to keep the cache in memory only)
+autopep8_options = {}
+format_cache = OrderedDict()
+format_cache_size = 512
+format_cache_lock = threading.Lock()
+format_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pybook', 'format')
+format_executor = None
+
+# Profiles are saved here; profile_top rows are shown per view, and the sampling
+# profiler takes one stack sample per sample_interval seconds of CPU time
+profile_dir = '.pybook_profiles'
+profile_top = 15
+sample_interval = 0.005
+
+# bench: runs each repeat in a fresh interpreter after calibrating the loop count so a
+# repeat takes at least bench_min_time seconds; results are kept in bench_history_file
+bench_repeats = 7
+bench_warmups = 1
+bench_min_time = 0.2
+bench_history_file = '.pybook_bench.json'
+
+# Number of allocation sites memprofile: reports
+memory_top = 10
+
+# install: targets the environment chosen with env:activate (None for PyBook's own
+# interpreter), and keeps built wheels in wheelhouse_dir so later installs, in any
+# environment, can run from disk without the network
+active_env = None
+wheelhouse_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pybook', 'wheelhouse')
+
+
+class Cell:
+    def __init__(self, cell_id, code, output='', modules=()):
+        self.cell_id = cell_id
+        self.output = output
+        self.ok = True  # whether the cell's last run finished without an error
+        self.set_code(code, modules)
+
+    def set_code(self, code, modules=()):
+        self.code = code
+        self.defines, self.reads, self.imports = analyze_names(code, modules)
+        self.serial = not self.defines or has_other_effects(code)
+
+
+class NameCollector(ast.NodeVisitor):
+    """Collects the global names one top-level statement loads and binds.
+
+    modules are names bound to imported modules, whose methods are not taken
+    to mutate them.
+    """
+
+    def __init__(self, modules=()):
+        self.loads = set()
+        self.stores = set()
+        self.imports = set()
+        self.scopes = []
+        self.modules = modules
+        self.function_depth = 0
+
+    def is_local(self, name):
+        return any(name in scope for scope in self.scopes)
+
+    def bind(self, name):
+        if not self.scopes:
+            self.stores.add(name)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            if not self.is_local(node.id):
+                self.loads.add(node.id)
+        else:
+            self.bind(node.id)
+
+    def visit_Attribute(self, node):
+        # Assigning to x.attr or x[key] mutates x, so the statement both uses and defines it
+        if not isinstance(node.ctx, ast.Load):
+            base = node.value
+            while isinstance(base, (ast.Attribute, ast.Subscript)):
+                base = base.value
+            if isinstance(base, ast.Name) and not self.is_local(base.id):
+                self.bind(base.id)
+        self.generic_visit(node)
+
+    visit_Subscript = visit_Attribute
+
+    def visit_Call(self, node):
+        # A method call such as items.append(x) or x = items.pop() is assumed to mutate its
+        # receiver wherever it appears, unless the receiver is a module as in time.sleep(1);
+        # calls inside function bodies only run when the function is called
+        func = node.func
+        if (isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and not self.function_depth
+                and not self.is_local(func.value.id) and func.value.id not in self.modules):
+            self.stores.add(func.value.id)
+        self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name) and not self.is_local(node.target.id):
+            self.loads.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name != '*':
+                self.bind(alias.asname or alias.name.split('.')[0])
+                if not self.scopes:
+                    self.imports.add(alias.asname or alias.name.split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_ExceptHandler(self, node):
+        if node.name:
+            self.bind(node.name)
+        self.generic_visit(node)
+
+    def visit_Global(self, node):
+        # A function that declares a global may rebind it whenever it is called
+        self.stores.update(node.names)
+
+    def visit_FunctionDef(self, node):
+        self.bind(node.name)
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self.visit_arguments_outside(node.args)
+        if node.returns:
+            self.visit(node.returns)
+        self.visit_scope(node.args, node.body)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        self.visit_arguments_outside(node.args)
+        self.visit_scope(node.args, [node.body])
+
+    def visit_ClassDef(self, node):
+        self.bind(node.name)
+        for child in node.bases + node.keywords + node.decorator_list:
+            self.visit(child)
+        self.visit_scope(None, node.body)
+
+    def visit_comprehension_scope(self, node):
+        targets = set()
+        for generator in node.generators:
+            targets.update(name.id for name in ast.walk(generator.target) if isinstance(name, ast.Name))
+        self.scopes.append(targets)
+        self.generic_visit(node)
+        self.scopes.pop()
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_comprehension_scope
+
+    def visit_arguments_outside(self, args):
+        # Defaults and annotations are evaluated in the enclosing scope
+        for default in args.defaults + [d for d in args.kw_defaults if d is not None]:
+            self.visit(default)
+
+    def visit_scope(self, args, body):
+        local_names = set()
+        if args is not None:
+            for arg in args.posonlyargs + args.args + args.kwonlyargs + [args.vararg, args.kwarg]:
+                if arg is not None:
+                    local_names.add(arg.arg)
+        declared_global = set()
+        for statement in body:
+            local_names |= bound_names(statement)
+            for node in ast.walk(statement):
+                if isinstance(node, ast.Global):
+                    declared_global.update(node.names)
+        self.scopes.append(local_names - declared_global)
+        self.function_depth += args is not None
+        for statement in body:
+            self.visit(statement)
+        self.function_depth -= args is not None
+        self.scopes.pop()
+
+
+def bound_names(node):
+    """Names a statement binds in its own scope, without looking inside nested scopes."""
+    names = set()
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, (ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        return names
+    if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+        names.add(node.id)
+    elif isinstance(node, (ast.Import, ast.ImportFrom)):
+        names.update(alias.asname or alias.name.split('.')[0] for alias in node.names if alias.name != '*')
+    elif isinstance(node, ast.ExceptHandler) and node.name:
+        names.add(node.name)
+    for child in ast.iter_child_nodes(node):
+        names |= bound_names(child)
+    return names
+
+
+def analyze_names(code, modules=()):
+    """Return (defines, reads, imports) for a cell.
+
+    defines holds the global names the cell binds or mutates, reads holds the
+    global names it uses before binding them itself, and imports the names it
+    binds with import statements. modules are names imported by earlier cells.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set(), set(), set()
+    defines, reads, imports = set(), set(), set()
+    for statement in tree.body:
+        collector = NameCollector(imports | set(modules))
+        collector.visit(statement)
+        reads |= collector.loads - defines
+        defines |= collector.stores
+        imports |= collector.imports
+    return defines, reads, imports
+
+
+def has_other_effects(code):
+    """Whether a cell may do more than bind values that a forked worker can pickle back.
+
+    Bare calls such as os.chdir(path) or random.seed(1) are run for their
+    side effects, and del, global and nonlocal change the namespace in ways
+    a worker can't report. Functions, classes, lambdas and modules don't
+    pickle. A method call on a name, as in x = items.pop(), counts as
+    defining that name (see NameCollector.visit_Call), so the mutated value
+    is sent back and cells reading it go in a later wave. What's left
+    unchecked are calls that mutate their arguments, as in x = f(items),
+    and module state changed by a bound call, as in r = random.random().
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return True
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda, ast.Import,
+                             ast.ImportFrom, ast.Delete, ast.Global, ast.Nonlocal)):
+            return True
+        if isinstance(node, ast.Expr) and isinstance(node.value, (ast.Call, ast.Await, ast.Yield, ast.YieldFrom)):
+            return True
+    return False
+
+
+def imported_names():
+    return set().union(*(cell.imports for cell in code_output_log))
+
+
+def schedule_waves(cells):
+    """Group cells into waves that can each run in parallel.
+
+    A cell goes in the wave after every earlier cell it conflicts with: one
+    that defines a name it reads or defines, or that reads a name it defines.
+    Serial cells conflict with every other cell, so each runs alone, in the
+    kernel, after everything before it and before everything after it.
+    """
+    levels = []
+    for index, cell in enumerate(cells):
+        level = 0
+        for earlier, earlier_level in zip(cells[:index], levels):
+            if (cell.serial or earlier.serial or earlier.defines & (cell.reads | cell.defines)
+                    or earlier.reads & cell.defines):
+                level = max(level, earlier_level + 1)
+        levels.append(level)
+    waves = [[] for _ in range(max(levels, default=-1) + 1)]
+    for cell, level in zip(cells, levels):
+        waves[level].append(cell)
+    return waves
+
+
+def find_cell(cell_id):
+    for index, cell in enumerate(code_output_log):
+        if cell.cell_id == cell_id:
+            return index
+    return None
+
+
+def stale_cells(index, previous_defines):
+    """Return the cells that must re-run after code_output_log[index] changes.
+
+    A later cell is stale if it reads a name an earlier stale cell defines, or
+    if it redefines one; the latter has to run again so the kernel namespace
+    ends up holding its value rather than the re-run cell's.
+    """
+    cell = code_output_log[index]
+    dirty = previous_defines | cell.defines
+    stale = [cell]
+    for later in code_output_log[index + 1:]:
+        if (later.reads | later.defines) & dirty:
+            stale.append(later)
+            dirty |= later.defines
+    return stale
+
+
+def cell_dependencies(index):
+    """Ids of the cells whose definitions code_output_log[index] reads."""
+    cell = code_output_log[index]
+    producers = {}
+    for earlier in code_output_log[:index]:
+        for name in earlier.defines:
+            producers[name] = earlier.cell_id
+    return sorted({producers[name] for name in cell.reads if name in producers})
+
+
+class CellOutput:
+    # With echo off nothing is printed, as in run:all's workers, which only collect output;
+    # spill_dir lets a worker whose cells may have changed directory spill where PyBook does
+    def __init__(self, cell, echo=True, spill_dir=None):
+        self.cell = cell
+        self.echo = echo
+        self.spill_dir = spill_dir or output_spill_dir
+        self.pending = {'stdout': '', 'stderr': ''}
+        self.kept = []
+        self.kept_chars = 0
+        self.spill_file = None
+        self.spill_path = None
+        self.spilled_chars = 0
+        self.stdin_eof = False
+
+    def write(self, stream, text):
+        # Print complete lines as soon as they arrive and hold back a trailing partial line
+        lines = (self.pending[stream] + text).split('\n')
+        self.pending[stream] = lines.pop()
+        for line in lines:
+            self.emit(stream, line + '\n')
+
+    def emit(self, stream, text):
+        # Cells run with stdin on /dev/null, so input() fails with the last line of an EOFError traceback
+        if stream == 'stderr' and text.startswith('EOFError'):
+            self.stdin_eof = True
+        if self.echo:
+            console.print(text, end='', style="red" if stream == 'stderr' else None,
+                          markup=False, highlight=False, soft_wrap=True)
+        room = max_output_chars - self.kept_chars
+        if room > 0:
+            self.kept.append(text[:room])
+            self.kept_chars += len(text[:room])
+            text = text[room:]
+        if text:
+            if self.spill_file is None:
+                import tempfile
+                os.makedirs(self.spill_dir, exist_ok=True)
+                fd, self.spill_path = tempfile.mkstemp(prefix=f"cell-{self.cell}-", suffix='.log', dir=self.spill_dir)
+                self.spill_file = os.fdopen(fd, 'w')
+            self.spill_file.write(text)
+            self.spilled_chars += len(text)
+
+    def finish(self):
+        for stream, text in self.pending.items():
+            if text:
+                self.emit(stream, text)
+                self.pending[stream] = ''
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def result(self):
+        self.finish()
+        if self.echo and self.stdin_eof:
+            console.print("[bold yellow]Cells can't read from the terminal: stdin is empty, so input() raises "
+                          "EOFError. Set the value in the cell's code instead.[/bold yellow]")
+        result = ''.join(self.kept)
+        if self.spilled_chars:
+            result += f"\n[{self.spilled_chars} more characters saved to {self.spill_path}]\n"
+        return result
+
+
+class OutputStream:
+    """A file-like object that writes one stream of a CellOutput, for redirect_stdout and redirect_stderr."""
+
+    def __init__(self, output, stream):
+        self.output = output
+        self.stream = stream
+
+    def write(self, text):
+        self.output.write(self.stream, text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def stream_process(process, output, reply_fd=None, timeout=None):
+    """Stream process's stdout and stderr into output.
+
+    Returns once a reply line arrives on reply_fd, or once the process closes
+    its output when there is no reply_fd. A timeout or Ctrl-C sends SIGINT to
+    the process group; if it is still running interrupt_grace seconds later it
+    is killed. Returns (status, reply) where status is 'ok', 'timeout',
+    'interrupted' or 'killed', and reply is the decoded reply or None.
+    """
+    selector = selectors.DefaultSelector()
+    decoders = {}
+    for stream, pipe in (('stdout', process.stdout), ('stderr', process.stderr)):
+        selector.register(pipe, selectors.EVENT_READ, stream)
+        decoders[stream] = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    if reply_fd is not None:
+        selector.register(reply_fd, selectors.EVENT_READ, 'reply')
+
+    def read_ready(wait):
+        events = selector.select(wait)
+        for key, _ in events:
+            data = os.read(key.fd, 65536)
+            if not data:
+                selector.unregister(key.fileobj)
+                if key.data == 'reply':
+                    finished.append(None)
+            elif key.data == 'reply':
+                reply_buffer.extend(data)
+                if b'\n' in reply_buffer:
+                    finished.append(json.loads(reply_buffer[:reply_buffer.index(b'\n')]))
+            else:
+                output.write(key.data, decoders[key.data].decode(data))
+        return events
+
+    def stop(status):
+        if status == 'killed':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            os.killpg(process.pid, signal.SIGINT)
+
+    status = 'ok'
+    finished = []
+    reply_buffer = bytearray()
+    deadline = time.monotonic() + timeout if timeout else None
+    try:
+        while not finished and (reply_fd is not None or selector.get_map()):
+            try:
+                wait = None if deadline is None else max(0, deadline - time.monotonic())
+                if not read_ready(wait) and deadline is not None and time.monotonic() >= deadline:
+                    status = 'timeout' if status == 'ok' else 'killed'
+                    stop(status)
+                    deadline = time.monotonic() + interrupt_grace
+                    if status == 'killed':
+                        break
+            except KeyboardInterrupt:
+                status = 'interrupted' if status == 'ok' else 'killed'
+                stop(status)
+                deadline = time.monotonic() + interrupt_grace
+                if status == 'killed':
+                    break
+        # Anything the process wrote before replying is already sitting in the pipes
+        while selector.get_map() and read_ready(0):
+            pass
+    finally:
+        selector.close()
+    return status, finished[0] if finished else None
+
+
+class Kernel:
+    def __init__(self):
+        self.process = None
+        self.requests = None
+        self.reply_fd = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    @timings.timed('subprocess', 'kernel spawn')
+    def start(self):
+        request_read, request_write = os.pipe()
+        reply_read, reply_write = os.pipe()
+        self.process = subprocess.Popen(
+            [env_python(), '-u', os.path.abspath(__file__), '--kernel', str(request_read), str(reply_write)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            pass_fds=(request_read, reply_write),
+            start_new_session=True,
+        )
+        os.close(request_read)
+        os.close(reply_write)
+        self.requests = os.fdopen(request_write, 'w', buffering=1)
+        self.reply_fd = reply_read
+
+    def shutdown(self):
+        if self.process is None:
+            return
+        self.requests.close()
+        os.close(self.reply_fd)
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process = None
+
+    def restart(self):
+        self.shutdown()
+        self.start()
+
+    def request(self, request, output, timeout=None):
+        if not self.is_alive():
+            self.shutdown()
+            self.start()
+        try:
+            self.requests.write(json.dumps(request) + '\n')
+        except BrokenPipeError:
+            pass
+        status, reply = stream_process(self.process, output, self.reply_fd, timeout)
+        if reply is None:
+            # The kernel exited or was killed mid-cell, so its namespace is gone
+            returncode = self.process.wait()
+            self.shutdown()
+            return {'ok': False, 'status': status, 'died': returncode}
+        reply['status'] = status
+        return reply
+
+    def execute(self, code, output, cell=None, timeout=None):
+        return self.request({'op': 'execute', 'code': code, 'cell': cell}, output, timeout)
+
+    def execute_parallel(self, cells, output, workers, timeout=None):
+        request = {
+            'op': 'parallel',
+            'workers': workers,
+            'spill_dir': os.path.abspath(output_spill_dir),
+            'cells': [{'cell': cell.cell_id, 'code': cell.code, 'defines': sorted(cell.defines)} for cell in cells],
+        }
+        return self.request(request, output, timeout)
+
+
+kernel = Kernel()
+
+# The namespace cells run in, when this process is the kernel
+kernel_namespace = {'__name__': '__main__', '__builtins__': builtins}
+
+# With memory tracking on the kernel keeps tracemalloc snapshots of the last two cells
+memory_tracking = False
+memory_snapshots = []
+
+
+def exec_cell(code, cell_id, profiler=None):
+    cell_name = f"<cell {cell_id}>" if cell_id is not None else "<cell>"
+    # Register the source so tracebacks can show the offending lines
+    linecache.cache[cell_name] = (len(code), None, code.splitlines(True), cell_name)
+    try:
+        # A profiler only runs around exec itself, so compiling the cell isn't part of its profile
+        compiled = compile(code, cell_name, 'exec')
+        if profiler is not None:
+            profiler.enable()
+        try:
+            exec(compiled, kernel_namespace)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except BaseException as exc:
+        # Drop this function's frame from the reported traceback
+        traceback.print_exception(type(exc), exc, exc.__traceback__.tb_next)
+        return False
+    return True
+
+def exec_forked_cell(code, cell_id, defines, spill_dir):
+    import pickle
+    from contextlib import redirect_stdout, redirect_stderr
+    # Runs in a worker forked from the kernel, so it sees the namespace as of the fork;
+    # the names the cell defines are pickled back for the kernel to merge. Output past
+    # max_output_chars is spilled here, so only the capped part is sent back.
+    output = CellOutput(cell_id, echo=False, spill_dir=spill_dir)
+    with redirect_stdout(OutputStream(output, 'stdout')), redirect_stderr(OutputStream(output, 'stderr')):
+        ok = exec_cell(code, cell_id)
+    values, unpicklable = {}, []
+    for name in defines:
+        if name in kernel_namespace:
+            try:
+                values[name] = pickle.dumps(kernel_namespace[name])
+            except Exception:
+                unpicklable.append(name)
+    # A cell is never run a second time in the kernel, since that would repeat whatever else
+    # it did; if some of its values can't be sent back, none are and the cell fails
+    if unpicklable:
+        ok, values = False, {}
+        output.write('stderr', f"{', '.join(sorted(unpicklable))} can't be sent back from a worker process; "
+                               f"cell {cell_id} will run in the kernel from now on.\n")
+    output.finish()
+    captured = {'text': ''.join(output.kept), 'spilled': output.spilled_chars, 'spill_path': output.spill_path}
+    return ok, captured, values, unpicklable
+
+def kernel_execute(request):
+    ok = exec_cell(request['code'], request['cell'])
+    if memory_tracking:
+        import tracemalloc
+        memory_snapshots.append((request['cell'], tracemalloc.take_snapshot()))
+        del memory_snapshots[:-2]
+    return {'ok': ok}
+
+def kernel_run_parallel(request):
+    import pickle
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    cells = request['cells']
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=min(request['workers'], len(cells)), mp_context=context) as pool:
+        futures = [pool.submit(exec_forked_cell, cell['code'], cell['cell'], cell['defines'], request['spill_dir'])
+                   for cell in cells]
+        results = []
+        for cell, future in zip(cells, futures):
+            try:
+                ok, output, values, unpicklable = future.result()
+            except Exception as exc:
+                output = {'text': f"Worker failed: {exc!r}\n", 'spilled': 0, 'spill_path': None}
+                ok, values, unpicklable = False, {}, []
+            for name, value in values.items():
+                kernel_namespace[name] = pickle.loads(value)
+            results.append({'cell': cell['cell'], 'ok': ok, 'output': output, 'unpicklable': unpicklable})
+    return {'ok': all(result['ok'] for result in results), 'results': results}
+
+class SamplingProfiler:
+    """Records the Python call stack on every SIGPROF tick of CPU time.
+
+    The collected stats use cProfile's layout so pstats can load, sort and
+    compare them: call counts are sample counts and times are estimated as
+    samples * interval.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.own_samples = Counter()
+        self.total_samples = Counter()
+        self.edge_samples = Counter()
+        self.previous_handler = None
+        self.stats = {}
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None and frame.f_code is not exec_cell.__code__:
+            code = frame.f_code
+            stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        if not stack:
+            return
+        self.own_samples[stack[0]] += 1
+        # Count recursive functions and call edges once per sample
+        self.total_samples.update(set(stack))
+        self.edge_samples.update(set(zip(stack[1:], stack)))
+
+    def enable(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler)
+
+    def create_stats(self):
+        callers = {}
+        for (caller, callee), count in self.edge_samples.items():
+            callers.setdefault(callee, {})[caller] = (count, count, 0.0, count * self.interval)
+        self.stats = {}
+        for func, count in self.total_samples.items():
+            own = self.own_samples[func]
+            self.stats[func] = (count, count, own * self.interval, count * self.interval, callers.get(func, {}))
+
+    def dump_stats(self, path):
+        self.create_stats()
+        with open(path, 'wb') as file:
+            marshal.dump(self.stats, file)
+
+
+def profile_to_file(code, cell_id, mode, path, interval):
+    import cProfile
+    profiler = SamplingProfiler(interval) if mode == 'sample' else cProfile.Profile()
+    ok = exec_cell(code, cell_id, profiler)
+    profiler.create_stats()
+    # cProfile also sees the exec that starts the cell and the call that stops it; leave
+    # them out so, as with the sampling profiler, only the cell's own code is reported
+    harness = {key for key in profiler.stats
+               if key[0] == __file__ or key[2] in ('<built-in method builtins.exec>',
+                                                   "<method 'disable' of '_lsprof.Profiler' objects>")}
+    stats = {}
+    for key, (calls, primitive, own, total, callers) in profiler.stats.items():
+        if key not in harness:
+            stats[key] = (calls, primitive, own, total,
+                          {caller: value for caller, value in callers.items() if caller not in harness})
+    with open(path, 'wb') as file:
+        marshal.dump(stats, file)
+    return ok
+
+def kernel_profile(request):
+    return {'ok': profile_to_file(request['code'], request['cell'], request['mode'], request['path'], request['interval'])}
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def allocation_sites(after, before, limit):
+    import tracemalloc
+    # Leave out the tracing machinery and PyBook's own bookkeeping
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, os.path.abspath(__file__)),
+               tracemalloc.Filter(False, linecache.__file__)]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+    return [{'site': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", 'size': stat.size_diff,
+             'count': stat.count_diff, 'total': stat.size} for stat in stats[:limit]]
+
+def kernel_memprofile(request):
+    import tracemalloc
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    baseline, _ = tracemalloc.get_traced_memory()
+    ok = exec_cell(request['code'], request['cell'])
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    if started:
+        tracemalloc.stop()
+    return {'ok': ok, 'growth': current - baseline, 'peak': peak - baseline, 'rss': current_rss(), 'peak_rss': peak_rss(),
+            'sites': allocation_sites(after, before, request['limit'])}
+
+def kernel_memtrack(request):
+    import tracemalloc
+    global memory_tracking
+    memory_tracking = request['enabled']
+    memory_snapshots.clear()
+    if memory_tracking and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not memory_tracking and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return {'ok': True}
+
+def kernel_memdiff(request):
+    if len(memory_snapshots) < 2:
+        return {'ok': False}
+    (before_cell, before), (after_cell, after) = memory_snapshots
+    growth = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return {'ok': True, 'cells': [before_cell, after_cell], 'growth': growth, 'rss': current_rss(),
+            'peak_rss': peak_rss(), 'sites': allocation_sites(after, before, request['limit'])}
+
+kernel_handlers = {
+    'execute': kernel_execute,
+    'parallel': kernel_run_parallel,
+    'profile': kernel_profile,
+    'memprofile': kernel_memprofile,
+    'memtrack': kernel_memtrack,
+    'memdiff': kernel_memdiff,
+}
+
+def run_kernel(request_fd, reply_fd):
+    # Ctrl-C only reaches the kernel as a forwarded SIGINT, and only matters while a cell runs
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with os.fdopen(request_fd, 'r') as requests, os.fdopen(reply_fd, 'w', buffering=1) as replies:
+        for line in requests:
+            request = json.loads(line)
+            try:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                try:
+                    reply = kernel_handlers[request['op']](request)
+                finally:
+                    signal.signal(signal.SIGINT, signal.SIG_IGN)
+            except KeyboardInterrupt:
+                reply = {'ok': False}
+            sys.stdout.flush()
+            sys.stderr.flush()
+            replies.write(json.dumps(reply) + '\n')
+
+def append_to_script(filename, code):
+    """Append a cell to the script; returns the script's previous size, for remove_from_script."""
     with open(filename, 'a') as file:
+        size = file.tell()
         file.write(f"\n{code}\n")
+    return size
+
+def remove_from_script(filename, size):
+    os.truncate(filename, size)
+
+def report_cell_status(status, timeout):
+    if status == 'timeout':
+        console.print(f"[bold red]Cell exceeded the {timeout:g}s timeout and was interrupted.[/bold red]")
+    elif status == 'interrupted':
+        console.print("[bold red]Cell cancelled.[/bold red]")
+    elif status == 'killed':
+        console.print("[bold red]Cell did not stop after being interrupted and was killed.[/bold red]")
+
+def run_cell_in_kernel(cell):
+    output = CellOutput(cell.cell_id)
+    with timings.span('kernel', 'execute'):
+        reply = kernel.execute(cell.code, output, cell.cell_id, cell_timeout)
+    cell.output = output.result()
+    cell.ok = reply['ok']
+    report_cell_status(reply['status'], cell_timeout)
+    if 'died' in reply:
+        console.print(f"[bold red]Kernel exited with code {reply['died']}; its variables have been lost.[/bold red]")
+    return reply['ok']
+
+def execute_code_in_kernel(filename, code, cell_id=None):
+    # autopep8 only changes layout, so the cell can run while it is being formatted
+    formatting = format_code_async(code)
+    console.print(f"Executing code in [bold green]kernel[/bold green] (exported to {filename})...", style="bold green")
+    cell = Cell(cell_id, code, modules=imported_names())
+    ok = run_cell_in_kernel(cell)
+    cell.code = formatting.result()
+    # A failing cell would make the script fail at that point every time it is run
+    if ok:
+        append_to_script(filename, cell.code)
+    display_syntax(cell.code)
+    code_output_log.append(cell)
+    record_cell(cell)
+    return cell.output
+
+def execute_code_in_file(filename, code, cell_id=None):
+    script_size = append_to_script(filename, code)
     console.print(f"Executing code in [bold green]{filename}[/bold green]...", style="bold green")
-    result = os.popen(f"python3 {filename}").read()
+    output = CellOutput(cell_id)
+    if os.name == 'posix':
+        # Spawning is timed apart from running, to show how much of a cell is interpreter startup
+        with timings.span('subprocess', 'spawn'):
+            process = subprocess.Popen([env_python(), '-u', filename], stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        with timings.span('subprocess', 'run'), process:
+            status, _ = stream_process(process, output, timeout=cell_timeout)
+        report_cell_status(status, cell_timeout)
+        ok = status == 'ok' and process.returncode == 0
+    else:
+        with timings.span('subprocess', 'run'):
+            process = subprocess.run([env_python(), filename], capture_output=True, text=True)
+        output.write('stdout', process.stdout)
+        output.write('stderr', process.stderr)
+        ok = process.returncode == 0
+    result = output.result()
+    if not ok:
+        # Every later cell re-runs the whole script, so a failing cell is taken back out of it
+        remove_from_script(filename, script_size)
+        console.print(f"[bold yellow]The cell failed, so it was not kept in {filename}.[/bold yellow]")
     # Log the code and output
-    code_output_log.append((code, result))
+    code_output_log.append(Cell(cell_id, code, result, imported_names()))
+    code_output_log[-1].ok = ok
+    record_cell(code_output_log[-1])
     return result
 
-def install_package(package_name):
-    console.print(f"[bold cyan]Installing package[/bold cyan] [bold magenta]{package_name}[/bold magenta]...", style="bold cyan")
-    os.system(f"pip install {package_name}")
+def rerun_cell(cell_id, code=None):
+    index = find_cell(cell_id)
+    if index is None:
+        console.print(f"[bold red]Error: No code cell {cell_id} to re-run.[/bold red]")
+        return
+    cell = code_output_log[index]
+    previous_defines = cell.defines
+    if code is not None:
+        cell.set_code(code, imported_names())
+        display_syntax(code)
+    stale = stale_cells(index, previous_defines)
+    cached = len(code_output_log) - index - len(stale)
+    console.print(f"[bold green]Re-running cells {', '.join(str(c.cell_id) for c in stale)}[/bold green]"
+                  f" ({cached} later cells unaffected)")
+    for position, cell in enumerate(stale):
+        console.print(f"[bold blue]Cell {cell.cell_id}[/bold blue]")
+        ok = run_cell_in_kernel(cell)
+        record_cell(cell)
+        if not ok:
+            skipped = stale[position + 1:]
+            if skipped:
+                console.print("[bold red]Stopped; cells "
+                              f"{', '.join(str(c.cell_id) for c in skipped)} were not re-run.[/bold red]")
+            return
+
+def run_all_cells(workers=None):
+    workers = workers or os.cpu_count() or 1
+    waves = schedule_waves(code_output_log)
+    console.print(f"[bold green]Running {len(code_output_log)} cells in {len(waves)} waves "
+                  f"on up to {workers} workers[/bold green]")
+    for number, wave in enumerate(waves):
+        if len(wave) == 1 or workers == 1 or os.name != 'posix':
+            failed = []
+            for cell in wave:
+                console.print(f"[bold blue]Cell {cell.cell_id}[/bold blue]")
+                if not run_cell_in_kernel(cell):
+                    failed.append(cell)
+                record_cell(cell)
+        else:
+            console.print(f"[bold green]Running cells {', '.join(str(c.cell_id) for c in wave)} in parallel[/bold green]")
+            output = CellOutput(None)
+            reply = kernel.execute_parallel(wave, output, workers, cell_timeout)
+            output.result()
+            report_cell_status(reply['status'], cell_timeout)
+            if 'died' in reply:
+                console.print(f"[bold red]Kernel exited with code {reply['died']}; its variables have been lost.[/bold red]")
+            results = {result['cell']: result for result in reply.get('results', [])}
+            failed = []
+            # Outputs are shown and logged in cell order regardless of which worker finished first
+            for cell in wave:
+                result = results.get(cell.cell_id, {'ok': False, 'output': {'text': '', 'spilled': 0}})
+                console.print(f"[bold blue]Cell {cell.cell_id}[/bold blue]")
+                # The worker kept at most max_output_chars and spilled the rest; this prints
+                # and stores the kept part just as a serial cell's output would be
+                cell_output = CellOutput(cell.cell_id)
+                cell_output.write('stdout', result['output']['text'])
+                cell_output.spilled_chars = result['output']['spilled']
+                cell_output.spill_path = result['output'].get('spill_path')
+                cell.output = cell_output.result()
+                cell.ok = result['ok']
+                if result.get('unpicklable'):
+                    cell.serial = True
+                record_cell(cell)
+                if not result['ok']:
+                    failed.append(cell)
+        if failed:
+            remaining = [cell for later in waves[number + 1:] for cell in later]
+            console.print(f"[bold red]Cells {', '.join(str(c.cell_id) for c in failed)} failed"
+                          + (f"; cells {', '.join(str(c.cell_id) for c in remaining)} were not run." if remaining else ".")
+                          + "[/bold red]")
+            return
+
+def show_cells():
+    from rich.table import Table
+    table = Table(title="Cells", style="cyan")
+    table.add_column("Cell", justify="right")
+    table.add_column("Defines")
+    table.add_column("Reads")
+    table.add_column("Depends on")
+    for index, cell in enumerate(code_output_log):
+        table.add_row(str(cell.cell_id), ', '.join(sorted(cell.defines)), ', '.join(sorted(cell.reads)),
+                      ', '.join(str(cell_id) for cell_id in cell_dependencies(index)))
+    console.print(table)
+
+def export_script(filename):
+    # Cells whose last run failed are left out, so the script runs through
+    cells = [cell for cell in code_output_log if cell.ok]
+    with open(filename, 'w') as file:
+        for cell in cells:
+            file.write(f"\n{cell.code}\n")
+    skipped = len(code_output_log) - len(cells)
+    console.print(f"[bold green]Exported {len(cells)} cells to {filename}[/bold green]"
+                  + (f" ({skipped} failing cells left out)" if skipped else ""))
+
+INSTALL_CHECK = """
+import json, re, sys
+from importlib import metadata
+try:
+    from packaging.requirements import Requirement
+except ImportError:
+    try:
+        from pip._vendor.packaging.requirements import Requirement
+    except ImportError:
+        Requirement = None
+missing = []
+for text in json.loads(sys.argv[1]):
+    try:
+        if Requirement is not None:
+            requirement = Requirement(text)
+            if requirement.marker is not None and not requirement.marker.evaluate():
+                continue
+            if requirement.url or requirement.extras:
+                raise ValueError(text)
+            name, specifier = requirement.name, requirement.specifier
+        elif re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9._-]*', text):
+            name, specifier = text, None
+        else:
+            raise ValueError(text)
+        version = metadata.version(name)
+        if specifier is not None and not specifier.contains(version, prereleases=True):
+            raise ValueError(text)
+    except Exception:
+        missing.append(text)
+print(json.dumps(missing))
+"""
+
+def env_python(env_name=None):
+    env_name = env_name or active_env
+    if env_name is None:
+        return sys.executable
+    if os.name == 'posix':
+        return os.path.join(env_name, 'bin', 'python')
+    return os.path.join(env_name, 'Scripts', 'python.exe')
+
+def missing_requirements(python, requirements):
+    # Checked with importlib.metadata in the target interpreter, which is much cheaper than starting pip
+    process = subprocess.run([python, '-c', INSTALL_CHECK, json.dumps(requirements)], capture_output=True, text=True)
+    if process.returncode != 0:
+        return requirements
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def install_package(package_names):
+    """Install one or more requirements into the active environment with a single pip resolve.
+
+    Requirements that are already satisfied are skipped without starting pip.
+    The rest are installed from the wheelhouse alone when it has everything
+    they need; otherwise pip builds or downloads the missing wheels into it
+    first, and installs from it after that.
+    """
+    import shlex
+    try:
+        requirements = shlex.split(package_names)
+    except ValueError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+        return
+    python = env_python()
+    target = active_env or 'the current environment'
+    missing = missing_requirements(python, requirements)
+    satisfied = [requirement for requirement in requirements if requirement not in missing]
+    if satisfied:
+        console.print(f"[bold green]Already satisfied:[/bold green] {', '.join(satisfied)}")
+    if not missing:
+        return
+    console.print(f"[bold cyan]Installing package[/bold cyan] [bold magenta]{' '.join(missing)}[/bold magenta] into {target}...", style="bold cyan")
+    os.makedirs(wheelhouse_dir, exist_ok=True)
+    offline = [python, '-m', 'pip', 'install', '--no-index', '--find-links', wheelhouse_dir, *missing]
+    process = subprocess.run(offline, capture_output=True, text=True)
+    if process.returncode == 0:
+        console.print(f"[bold green]Installed from the wheelhouse:[/bold green] {' '.join(missing)}")
+        return
+    console.print("[bold yellow]Not all wheels are cached, fetching them into the wheelhouse...[/bold yellow]")
+    process = subprocess.run([python, '-m', 'pip', 'wheel', '--wheel-dir', wheelhouse_dir,
+                              '--find-links', wheelhouse_dir, *missing])
+    if process.returncode == 0:
+        process = subprocess.run(offline)
+    if process.returncode != 0:
+        console.print(f"[bold red]Error: pip exited with code {process.returncode}[/bold red]")
+
+def format_cache_key(code, options):
+    import hashlib
+    import autopep8
+    payload = json.dumps([autopep8.__version__, sorted(options.items()), code])
+    return hashlib.sha256(payload.encode()).hexdigest()
 
-def format_code(code):
-    formatted_code = autopep8.fix_code(code)
+def format_code(code, options=None):
+    # Recorded as a 'cached' or 'autopep8' span, so cache misses show up on their own in stats:
+    with timings.span('format', 'cached') as span:
+        return cached_format(code, autopep8_options if options is None else options, span)
+
+def cached_format(code, options, span):
+    import autopep8
+    import tempfile
+    key = format_cache_key(code, options)
+    with format_cache_lock:
+        if key in format_cache:
+            format_cache.move_to_end(key)
+            return format_cache[key]
+    cache_path = os.path.join(format_cache_dir, key[:2], key) if format_cache_dir else None
+    formatted_code = None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as file:
+            formatted_code = file.read()
+    if formatted_code is None:
+        span.name = 'autopep8'
+        formatted_code = autopep8.fix_code(code, options=options or None)
+        if cache_path:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+                with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                    file.write(formatted_code)
+                os.replace(temp_path, cache_path)
+            except OSError:
+                pass
+    with format_cache_lock:
+        format_cache[key] = formatted_code
+        while len(format_cache) > format_cache_size:
+            format_cache.popitem(last=False)
     return formatted_code
 
+def format_code_async(code):
+    global format_executor
+    if format_executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        format_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pybook-format')
+    return format_executor.submit(format_code, code)
+
 def create_virtualenv(env_name):
     if not os.path.exists(env_name):
         console.print(f"[bold yellow]Creating virtual environment: {env_name}[/bold yellow]", style="bold yellow")
@@ -41,31 +1128,37 @@ def create_virtualenv(env_name):
         console.print(f"[bold yellow]Virtual environment '{env_name}' already exists![/bold yellow]")
 
 def activate_virtualenv(env_name):
-    if os.name == 'posix':
-        activate_script = f"./{env_name}/bin/activate"
-    else:
-        activate_script = f".\\{env_name}\\Scripts\\activate"
-    
+    # A child shell can't change PyBook's own environment, so activating an
+    # environment means running install:, cells and bench: with its interpreter
+    global active_env
+    if not os.path.exists(env_python(env_name)):
+        console.print(f"[bold red]Error: No Python interpreter found in '{env_name}'[/bold red]")
+        return
+    active_env = os.path.abspath(env_name)
     console.print(f"[bold green]Activating virtual environment: {env_name}[/bold green]", style="bold green")
-    os.system(f"source {activate_script}")
+    if kernel.is_alive():
+        kernel.restart()
+        console.print(f"[bold yellow]Kernel restarted with {env_python()}; all variables have been cleared.[/bold yellow]")
 
 def lint_code(code):
     console.print(f"[bold blue]Linting code...[/bold blue]", style="bold blue")
-    linted_code = autopep8.fix_code(code)
+    linted_code = format_code(code)
     return linted_code
 
 def display_syntax(code):
+    from rich.syntax import Syntax
     syntax = Syntax(code, "python", theme="monokai", line_numbers=True)
     console.print(syntax)
 
 def show_help():
+    from rich.panel import Panel
     help_text = """
 [bold green]Welcome to PyBook[/bold green] - An advanced terminal-based interactive Python notebook.
 Here are some commands you can use:
-[bold cyan]code:<your python code>[/bold cyan] - Append and execute Python code.
-[bold cyan]install:<package name>[/bold cyan] - Install a Python package via pip.
+[bold cyan]code:<your python code>[/bold cyan] - Execute Python code in the kernel and append it to the script file (cells can't read input; input() raises EOFError).
+[bold cyan]install:<package> [<package> ...][/bold cyan] - Install packages via pip, skipping satisfied ones and reusing cached wheels.
 [bold cyan]env:create <env_name>[/bold cyan] - Create a virtual environment.
-[bold cyan]env:activate <env_name>[/bold cyan] - Activate a virtual environment.
+[bold cyan]env:activate <env_name>[/bold cyan] - Use a virtual environment for install:, cells and bench: (restarts the kernel).
 [bold cyan]format:<your python code>[/bold cyan] - Format your Python code using autopep8.
 [bold cyan]lint:<your python code>[/bold cyan] - Lint your Python code for best practices.
 [bold cyan]file:create <filename>[/bold cyan] - Create a new file.
@@ -73,7 +1166,26 @@ Here are some commands you can use:
 [bold cyan]file:delete <filename>[/bold cyan] - Delete a file.
 [bold cyan]shell:<command>[/bold cyan] - Run a shell command.
 [bold cyan]profile:<your python code>[/bold cyan] - Profile your Python code for performance.
-[bold cyan]save:file[/bold cyan] - Save all code and outputs in a file (notes.pybook).
+[bold cyan]profile:sample <your python code>[/bold cyan] - Profile with the low-overhead sampling profiler (CPU time only).
+[bold cyan]profile:show <file.prof> [rows][/bold cyan] - Show a saved profile.
+[bold cyan]profile:diff <before.prof> <after.prof>[/bold cyan] - Compare two saved profiles.
+[bold cyan]edit:<cell> <code>[/bold cyan] - Replace a cell's code and re-run it with the cells that depend on it.
+[bold cyan]rerun:<cell>[/bold cyan] - Re-run a cell and the cells that depend on it.
+[bold cyan]run:all [workers][/bold cyan] - Re-run every cell, running cells with no dependencies between them in parallel (cells with bare calls, imports, functions or classes run alone in the kernel).
+[bold cyan]cells[/bold cyan] - Show the names each cell defines and reads, and its dependencies.
+[bold cyan]export:<filename>[/bold cyan] - Write the current code of every cell whose last run succeeded to a script.
+[bold cyan]timeout:<seconds|off>[/bold cyan] - Interrupt cells that run longer than this (Ctrl-C cancels a running cell).
+[bold cyan]kernel:restart[/bold cyan] - Restart the kernel, clearing all variables.
+[bold cyan]kernel:on[/bold cyan] / [bold cyan]kernel:off[/bold cyan] - Run cells in the persistent kernel, or re-run the whole script file per cell.
+[bold cyan]memprofile:<your python code>[/bold cyan] - Show where a cell allocates memory, its growth and peak RSS.
+[bold cyan]memprofile:track on|off[/bold cyan] - Snapshot memory after every cell; [bold cyan]memprofile:diff[/bold cyan] compares the last two.
+[bold cyan]bench:<statement> [;; <setup>][/bold cyan] - Benchmark a statement in isolated processes and compare with its last run.
+[bold cyan]stats:[/bold cyan] - Show timing percentiles for commands, formatting, subprocesses and rendering this session.
+[bold cyan]stats:export <file.json>[/bold cyan] / [bold cyan]stats:trace <file.json>[/bold cyan] - Save the timings as JSON or as a Chrome trace; [bold cyan]stats:clear[/bold cyan] resets them.
+[bold cyan]save:file[/bold cyan] - Check that all code and outputs are saved (cells are appended to notes.pybook as they finish).
+[bold cyan]save:text [filename][/bold cyan] - Write all code and outputs as plain text (default notes.txt).
+[bold cyan]load:[/bold cyan] - List the sessions saved in notes.pybook.
+[bold cyan]load:<session>[/bold cyan] - Reopen a saved session's cells; [bold cyan]load:<session>:<cell>[/bold cyan] shows one saved cell.
 [bold cyan]exit[/bold cyan] - Exit the PyBook interactive shell.
 """
     console.print(Panel(help_text, title="Help", style="bold yellow"))
@@ -99,46 +1211,559 @@ def delete_file(filename):
     else:
         console.print(f"[bold red]Error: File '{filename}' not found.[/bold red]")
 
-def profile_code(code):
-    profiler = cProfile.Profile()
-    profiler.enable()
+def function_label(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def caller_time(value):
+    # cProfile records (calls, primitive calls, own time, cumulative time) per caller
+    return value[3] if isinstance(value, tuple) else 0.0
+
+def profile_table(stats, title, sort_index, limit, sampled):
+    from rich.table import Table
+    table = Table(title=title, style="green")
+    table.add_column("Function", justify="left")
+    table.add_column("Samples" if sampled else "Calls", justify="right")
+    table.add_column("Own (s)", justify="right")
+    table.add_column("Cumulative (s)", justify="right")
+    table.add_column("Per call (ms)", justify="right")
+    ranked = sorted(stats.stats.items(), key=lambda item: item[1][sort_index], reverse=True)
+    for func, (primitive_calls, calls, own, cumulative, _) in ranked[:limit]:
+        count = str(calls) if calls == primitive_calls else f"{calls}/{primitive_calls}"
+        per_call = f"{cumulative / calls * 1000:.3f}" if calls and not sampled else "-"
+        table.add_row(function_label(func), count, f"{own:.4f}", f"{cumulative:.4f}", per_call)
+    return table
+
+def profile_tree(stats, limit):
+    from rich.tree import Tree
+    stats.calc_callees()
+    tree = Tree("[bold]Callers and callees of the most expensive functions[/bold]")
+    ranked = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+    for func, (_, _, own, cumulative, callers) in ranked[:limit]:
+        node = tree.add(f"[bold yellow]{function_label(func)}[/bold yellow] {cumulative:.4f}s cumulative, {own:.4f}s own")
+        if callers:
+            branch = node.add("[cyan]called by[/cyan]")
+            for caller, value in sorted(callers.items(), key=lambda item: caller_time(item[1]), reverse=True)[:5]:
+                branch.add(f"{function_label(caller)} {caller_time(value):.4f}s")
+        callees = stats.all_callees.get(func, {})
+        if callees:
+            branch = node.add("[magenta]calls[/magenta]")
+            for callee, value in sorted(callees.items(), key=lambda item: caller_time(item[1]), reverse=True)[:5]:
+                branch.add(f"{function_label(callee)} {caller_time(value):.4f}s")
+    return tree
+
+def show_profile(path, limit=None):
+    import pstats
+    limit = limit or profile_top
     try:
-        exec(code)
-    except Exception as e:
-        console.print(f"[bold red]Error during profiling: {str(e)}[/bold red]")
-    finally:
-        profiler.disable()
-        s = StringIO()
-        ps = pstats.Stats(profiler, stream=s)
-        ps.sort_stats(pstats.SortKey.TIME).print_stats()
-        console.print(Panel(s.getvalue(), title="Code Profiling Output", style="bold green"))
+        stats = pstats.Stats(path)
+    except (OSError, TypeError, ValueError, EOFError) as e:
+        console.print(f"[bold red]Error: Could not load profile '{path}': {e}[/bold red]")
+        return
+    sampled = path.endswith('.sample.prof')
+    kind = "sampled, times estimated from CPU samples" if sampled else "deterministic"
+    console.print(f"[bold green]Profile saved to {path}[/bold green] ({kind}, {stats.total_tt:.4f}s total)")
+    console.print(profile_table(stats, f"Top {limit} by own time", 2, limit, sampled))
+    console.print(profile_table(stats, f"Top {limit} by cumulative time", 3, limit, sampled))
+    console.print(profile_tree(stats, min(limit, 5)))
+
+def diff_profiles(path_a, path_b, limit=None):
+    import pstats
+    from rich.table import Table
+    limit = limit or profile_top
+    try:
+        before, after = pstats.Stats(path_a), pstats.Stats(path_b)
+    except (OSError, TypeError, ValueError, EOFError) as e:
+        console.print(f"[bold red]Error: Could not load profiles: {e}[/bold red]")
+        return
+    empty = (0, 0, 0.0, 0.0, {})
+    rows = []
+    for func in set(before.stats) | set(after.stats):
+        _, calls_a, own_a, cumulative_a, _ = before.stats.get(func, empty)
+        _, calls_b, own_b, cumulative_b, _ = after.stats.get(func, empty)
+        rows.append((func, calls_a, calls_b, own_a, own_b, cumulative_a, cumulative_b))
+    rows.sort(key=lambda row: abs(row[4] - row[3]), reverse=True)
+
+    table = Table(title=f"Profile diff: {path_a} -> {path_b}", style="green")
+    table.add_column("Function", justify="left")
+    table.add_column("Calls", justify="right")
+    table.add_column("Own before (s)", justify="right")
+    table.add_column("Own after (s)", justify="right")
+    table.add_column("Own change", justify="right")
+    table.add_column("Cumulative change", justify="right")
+    for func, calls_a, calls_b, own_a, own_b, cumulative_a, cumulative_b in rows[:limit]:
+        table.add_row(function_label(func), f"{calls_a} -> {calls_b}", f"{own_a:.4f}", f"{own_b:.4f}",
+                      format_change(own_a, own_b), format_change(cumulative_a, cumulative_b))
+    console.print(table)
+    console.print(f"Total: {before.total_tt:.4f}s -> {after.total_tt:.4f}s ({format_change(before.total_tt, after.total_tt)})")
+
+def format_change(before, after):
+    delta = after - before
+    colour = "red" if delta > 0 else "green"
+    percent = f" ({delta / before:+.1%})" if before else ""
+    return f"[{colour}]{delta:+.4f}s{percent}[/{colour}]"
+
+def profile_code(code, cell_id=None, sampling=False):
+    if sampling and not hasattr(signal, 'setitimer'):
+        console.print("[bold yellow]Sampling needs SIGPROF timers; using the deterministic profiler instead.[/bold yellow]")
+        sampling = False
+    os.makedirs(profile_dir, exist_ok=True)
+    suffix = '.sample.prof' if sampling else '.prof'
+    path = os.path.abspath(os.path.join(profile_dir, f"cell-{cell_id}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}"))
+    mode = 'sample' if sampling else 'deterministic'
+    if use_kernel:
+        output = CellOutput(cell_id)
+        request = {'op': 'profile', 'code': code, 'cell': cell_id, 'mode': mode, 'path': path, 'interval': sample_interval}
+        reply = kernel.request(request, output, cell_timeout)
+        output.result()
+        report_cell_status(reply['status'], cell_timeout)
+        if 'died' in reply:
+            console.print(f"[bold red]Kernel exited with code {reply['died']}; its variables have been lost.[/bold red]")
+            return
+    else:
+        profile_to_file(code, cell_id, mode, path, sample_interval)
+    show_profile(os.path.relpath(path))
+
+def format_size(size):
+    if size is None:
+        return "-"
+    sign = "-" if size < 0 else ""
+    size = abs(size)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{sign}{size:.0f} {unit}" if unit == "B" else f"{sign}{size:.1f} {unit}"
+        size /= 1024
+
+def pybook_footprint():
+    # PyBook itself holds every cell's code and output for the whole session
+    log_size = sum(sys.getsizeof(cell.code) + sys.getsizeof(cell.output) for cell in code_output_log)
+    return log_size, current_rss()
+
+def show_memory_report(title, reply, in_kernel=True):
+    from rich.table import Table
+    table = Table(title=title, style="magenta")
+    table.add_column("Allocation site", justify="left")
+    table.add_column("Net growth", justify="right")
+    table.add_column("Blocks", justify="right")
+    table.add_column("Live size", justify="right")
+    for site in reply['sites']:
+        table.add_row(site['site'], format_size(site['size']), f"{site['count']:+d}", format_size(site['total']))
+    console.print(table)
+
+    summary = Table(title="Memory summary", style="magenta")
+    summary.add_column("Measure", justify="left")
+    summary.add_column("Value", justify="right")
+    summary.add_row("Net growth (traced)", format_size(reply['growth']))
+    if 'peak' in reply:
+        summary.add_row("Peak above start (traced)", format_size(reply['peak']))
+    # With kernel:off the cell ran inside PyBook, so the reply's RSS already is PyBook's
+    process = "Kernel" if in_kernel else "PyBook"
+    summary.add_row(f"{process} RSS", format_size(reply['rss']))
+    summary.add_row(f"{process} peak RSS", format_size(reply['peak_rss']))
+    log_size, rss = pybook_footprint()
+    summary.add_row(f"PyBook cell log ({len(code_output_log)} cells)", format_size(log_size))
+    if in_kernel:
+        summary.add_row("PyBook RSS", format_size(rss))
+    console.print(summary)
+
+def memory_profile_code(code, cell_id=None):
+    request = {'op': 'memprofile', 'code': code, 'cell': cell_id, 'limit': memory_top}
+    if use_kernel:
+        output = CellOutput(cell_id)
+        reply = kernel.request(request, output, cell_timeout)
+        output.result()
+        report_cell_status(reply['status'], cell_timeout)
+        if 'died' in reply:
+            console.print(f"[bold red]Kernel exited with code {reply['died']}; its variables have been lost.[/bold red]")
+            return
+        if 'sites' not in reply:
+            return
+    else:
+        reply = kernel_memprofile(request)
+    show_memory_report(f"Top {memory_top} allocation sites", reply, use_kernel)
+
+def set_memory_tracking(enabled):
+    reply = kernel.request({'op': 'memtrack', 'enabled': enabled}, CellOutput(None))
+    if reply['ok'] and enabled:
+        console.print("[bold green]Memory tracking on: each cell is snapshotted for 'memprofile:diff' (cells run slower).[/bold green]")
+    elif reply['ok']:
+        console.print("[bold green]Memory tracking off.[/bold green]")
+
+def show_memory_diff():
+    reply = kernel.request({'op': 'memdiff', 'limit': memory_top}, CellOutput(None))
+    if not reply['ok']:
+        console.print("[bold red]Error: Turn on 'memprofile:track on' and run at least two cells first.[/bold red]")
+        return
+    before, after = reply['cells']
+    show_memory_report(f"Memory change from cell {before} to cell {after}", reply)
+
+BENCH_RUNNER = """
+import json, sys, timeit
+request = json.loads(sys.argv[1])
+timer = timeit.Timer(request['stmt'], request['setup'])
+if request['number'] is None:
+    number, elapsed = timer.autorange()
+    while elapsed < request['min_time']:
+        number *= 2
+        elapsed = timer.timeit(number)
+else:
+    number = request['number']
+    for _ in range(request['warmups']):
+        timer.timeit(number)
+    elapsed = timer.timeit(number)
+print(json.dumps({'number': number, 'elapsed': elapsed}))
+"""
+
+def run_bench_process(stmt, setup, number=None):
+    request = {'stmt': stmt, 'setup': setup, 'number': number, 'warmups': bench_warmups, 'min_time': bench_min_time}
+    process = subprocess.run([env_python(), '-c', BENCH_RUNNER, json.dumps(request)],
+                             capture_output=True, text=True, timeout=cell_timeout)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip() or f"benchmark process exited with code {process.returncode}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+def format_duration(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3f} {unit}"
+    return f"{seconds / 1e-9:.1f} ns"
+
+def summarize_timings(timings):
+    import statistics
+    ordered = sorted(timings)
+    median = statistics.median(ordered)
+    if len(ordered) >= 2:
+        q1, _, q3 = statistics.quantiles(ordered, n=4, method='inclusive')
+    else:
+        q1 = q3 = median
+    iqr = q3 - q1
+    outliers = [t for t in ordered if t < q1 - 1.5 * iqr or t > q3 + 1.5 * iqr]
+    return {'median': median, 'q1': q1, 'q3': q3, 'iqr': iqr, 'min': ordered[0], 'max': ordered[-1],
+            'outliers': len(outliers), 'timings': timings}
+
+def load_bench_history():
+    try:
+        with open(bench_history_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def compare_with_previous(previous, current):
+    change = current['median'] / previous['median'] - 1
+    # Only call it a change when the interquartile ranges of the two runs don't overlap
+    if current['q1'] > previous['q3']:
+        return f"[bold red]Regression: {change:+.1%} slower than the previous run ({format_duration(previous['median'])})[/bold red]"
+    if current['q3'] < previous['q1']:
+        return f"[bold green]Improvement: {-change:.1%} faster than the previous run ({format_duration(previous['median'])})[/bold green]"
+    return f"[bold yellow]No significant change from the previous run ({change:+.1%})[/bold yellow]"
+
+def benchmark_code(stmt, setup='pass'):
+    from rich.progress import Progress
+    from rich.table import Table
+    console.print("[bold cyan]Calibrating benchmark...[/bold cyan]")
+    try:
+        number = run_bench_process(stmt, setup)['number']
+        timings = []
+        with Progress(transient=True, console=console) as progress:
+            task = progress.add_task(f"Running {bench_repeats} isolated repeats of {number} loops", total=bench_repeats)
+            for _ in range(bench_repeats):
+                timings.append(run_bench_process(stmt, setup, number)['elapsed'] / number)
+                progress.advance(task)
+    except KeyboardInterrupt:
+        console.print("[bold red]Benchmark cancelled.[/bold red]")
+        return
+    except subprocess.TimeoutExpired:
+        console.print(f"[bold red]Error: Benchmark exceeded the {cell_timeout:g}s timeout.[/bold red]")
+        return
+    except RuntimeError as e:
+        console.print("[bold red]Error during benchmark:[/bold red]")
+        console.print(str(e), markup=False, highlight=False)
+        return
+    summary = summarize_timings(timings)
+
+    table = Table(title=f"Benchmark: {stmt}", style="cyan")
+    table.add_column("Metric", justify="left")
+    table.add_column("Value", justify="right")
+    table.add_row("Loops per repeat", str(number))
+    table.add_row("Repeats", f"{bench_repeats} (each in a new process, {bench_warmups} warmup)")
+    table.add_row("Median", format_duration(summary['median']))
+    table.add_row("IQR", f"{format_duration(summary['iqr'])} ({format_duration(summary['q1'])} - {format_duration(summary['q3'])})")
+    table.add_row("Min / Max", f"{format_duration(summary['min'])} / {format_duration(summary['max'])}")
+    table.add_row("Ops/sec", f"{1 / summary['median']:,.0f}" if summary['median'] else "-")
+    table.add_row("Outliers", f"{summary['outliers']} of {len(timings)}")
+    console.print(table)
+
+    import hashlib
+    key = hashlib.sha256(json.dumps([stmt, setup]).encode()).hexdigest()
+    history = load_bench_history()
+    runs = history.setdefault(key, {'stmt': stmt, 'setup': setup, 'runs': []})['runs']
+    if runs:
+        console.print(compare_with_previous(runs[-1], summary))
+    runs.append(dict(summary, recorded=time.time()))
+    with open(bench_history_file, 'w') as file:
+        json.dump(history, file, indent=2)
+
+def command_name(user_input):
+    # 'code:x = 1' is timed as 'code', 'env:create venv' as 'env', 'cells' as 'cells'
+    return user_input.partition(':')[0].split(' ')[0].lower() or 'empty'
+
+def show_stats():
+    table = timings.summary_table(format_duration)
+    console.print(table if table is not None else "[bold yellow]No timings recorded yet.[/bold yellow]")
+
+def export_stats(path, trace=False):
+    try:
+        console.print(timings.export_report(path, trace))
+    except OSError as e:
+        console.print(f"[bold red]Error: {e}[/bold red]")
+
+
+class NotebookStore:
+    """Append-only log of cells, written as each cell finishes.
+
+    The log starts with MAGIC and holds records, each a 4-byte big-endian length
+    followed by a UTF-8 JSON object. A sidecar .idx file holds one fixed-size
+    (session, cell, offset) entry per record, so any cell can be read with one
+    seek. Outputs larger than blob_threshold bytes go to zlib-compressed blobs
+    named by their SHA-256 in a .blobs directory next to the log.
+    """
+
+    MAGIC = b'PYBOOK1\n'
+    LENGTH = struct.Struct('>I')
+    INDEX_ENTRY = struct.Struct('>IqQ')
+
+    def __init__(self, path, blob_threshold=16 * 1024):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.blob_dir = path + '.blobs'
+        self.blob_threshold = blob_threshold
+        self.session = None
+
+    def is_log(self):
+        with open(self.path, 'rb') as log:
+            return log.read(len(self.MAGIC)) == self.MAGIC
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            self.sync_index()
+        except OSError:
+            # A read-only log or directory can still be listed and loaded, just not repaired
+            return self.read_entries()
+        return self.read_index()
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'rb') as index:
+                data = index.read()
+        except FileNotFoundError:
+            return []
+        size = self.INDEX_ENTRY.size
+        return [self.INDEX_ENTRY.unpack_from(data, start) for start in range(0, len(data) - len(data) % size, size)]
+
+    def read_entries(self):
+        """The index's entries plus those of any unindexed records, without writing anything."""
+        entries = self.read_index()
+        with open(self.path, 'rb') as log:
+            position = self.record_end(log, entries[-1][2]) if entries else len(self.MAGIC)
+            unindexed, _ = self.scan_records(log, position)
+        return entries + unindexed
+
+    def record_end(self, log, offset):
+        log.seek(offset)
+        return offset + self.LENGTH.size + self.LENGTH.unpack(log.read(self.LENGTH.size))[0]
+
+    def scan_records(self, log, position):
+        """Return (entries, end of the last whole record) for the records from position on."""
+        entries = []
+        end = log.seek(0, os.SEEK_END)
+        while position < end:
+            log.seek(position)
+            header = log.read(self.LENGTH.size)
+            if len(header) < self.LENGTH.size or position + self.LENGTH.size + self.LENGTH.unpack(header)[0] > end:
+                break
+            record = json.loads(log.read(self.LENGTH.unpack(header)[0]))
+            entries.append((record['session'], record['cell'], position))
+            position += self.LENGTH.size + self.LENGTH.unpack(header)[0]
+        return entries, position
+
+    def sync_index(self):
+        # Index any records a crash left unindexed, and drop a torn record at the end
+        size = self.INDEX_ENTRY.size
+        with open(self.index_path, 'ab+') as index:
+            index.seek(0, os.SEEK_END)
+            index.truncate(index.tell() - index.tell() % size)
+            position = len(self.MAGIC)
+            with open(self.path, 'rb+') as log:
+                if index.tell():
+                    index.seek(-size, os.SEEK_END)
+                    _, _, offset = self.INDEX_ENTRY.unpack(index.read(size))
+                    position = self.record_end(log, offset)
+                entries, position = self.scan_records(log, position)
+                for entry in entries:
+                    index.write(self.INDEX_ENTRY.pack(*entry))
+                if position < log.seek(0, os.SEEK_END):
+                    log.truncate(position)
+
+    def sessions(self):
+        sessions = {}
+        for session, cell_id, _ in self.entries():
+            sessions.setdefault(session, set()).add(cell_id)
+        return sessions
+
+    def append(self, cell):
+        if self.session is None:
+            self.session = max(self.sessions(), default=0) + 1
+        record = {'session': self.session, 'cell': cell.cell_id or 0, 'time': time.time(), 'code': cell.code}
+        output = cell.output.encode('utf-8')
+        if len(output) > self.blob_threshold:
+            import hashlib
+            digest = hashlib.sha256(output).hexdigest()
+            blob_path = os.path.join(self.blob_dir, digest + '.zz')
+            if not os.path.exists(blob_path):
+                os.makedirs(self.blob_dir, exist_ok=True)
+                with open(blob_path, 'wb') as blob:
+                    blob.write(zlib.compress(output))
+            record['output_blob'] = digest
+            record['output_size'] = len(output)
+        else:
+            record['output'] = cell.output
+        payload = json.dumps(record).encode('utf-8')
+        with open(self.path, 'ab') as log:
+            new_log = log.tell() == 0
+            if new_log:
+                log.write(self.MAGIC)
+            offset = log.tell()
+            log.write(self.LENGTH.pack(len(payload)) + payload)
+        # An index left behind by a deleted log must not be appended to
+        with open(self.index_path, 'wb' if new_log else 'ab') as index:
+            index.write(self.INDEX_ENTRY.pack(self.session, record['cell'], offset))
+
+    def read(self, offset):
+        with open(self.path, 'rb') as log:
+            log.seek(offset)
+            length, = self.LENGTH.unpack(log.read(self.LENGTH.size))
+            record = json.loads(log.read(length))
+        if 'output_blob' in record:
+            with open(os.path.join(self.blob_dir, record['output_blob'] + '.zz'), 'rb') as blob:
+                record['output'] = zlib.decompress(blob.read()).decode('utf-8')
+        return record
+
+    def latest(self, session):
+        # Later records for a cell (edits and re-runs) replace earlier ones
+        offsets = {}
+        for entry_session, cell_id, offset in self.entries():
+            if entry_session == session:
+                offsets[cell_id] = offset
+        return offsets
+
+
+notebook = NotebookStore('notes.pybook')
+
+def record_cell(cell):
+    try:
+        notebook.append(cell)
+    except OSError as e:
+        console.print(f"[bold red]Error: Could not save cell {cell.cell_id} to {notebook.path}: {e}[/bold red]")
+
+def open_notebook():
+    if os.path.exists(notebook.path) and not notebook.is_log():
+        # notes.pybook files from older versions are plain text and can't be appended to
+        backup = notebook.path + '.txt'
+        os.replace(notebook.path, backup)
+        console.print(f"[bold yellow]Moved the old text-format {notebook.path} to {backup}.[/bold yellow]")
+
+def list_sessions():
+    from rich.table import Table
+    try:
+        sessions = notebook.sessions()
+    except OSError as e:
+        console.print(f"[bold red]Error: Could not read {notebook.path}: {e}[/bold red]")
+        return
+    if not sessions:
+        console.print(f"[bold red]No saved sessions in {notebook.path}[/bold red]")
+        return
+    table = Table(title=f"Sessions in {notebook.path}", style="cyan")
+    table.add_column("Session", justify="right")
+    table.add_column("Cells", justify="left")
+    for session, cell_ids in sorted(sessions.items()):
+        table.add_row(str(session), ', '.join(str(cell_id) for cell_id in sorted(cell_ids)))
+    console.print(table)
+
+def show_saved_cell(session, cell_id):
+    try:
+        offset = notebook.latest(session).get(cell_id)
+        record = notebook.read(offset) if offset is not None else None
+    except OSError as e:
+        console.print(f"[bold red]Error: Could not read {notebook.path}: {e}[/bold red]")
+        return
+    if record is None:
+        console.print(f"[bold red]Error: No cell {cell_id} in session {session}.[/bold red]")
+        return
+    console.print(f"[bold blue]Session {session}, cell {cell_id}[/bold blue] ({time.ctime(record['time'])})")
+    display_syntax(record['code'])
+    console.print(record['output'], markup=False, highlight=False, soft_wrap=True)
+
+def load_session(session):
+    """Replace the current cells with a saved session's; returns the last cell id, or None."""
+    try:
+        offsets = notebook.latest(session)
+        records = [(cell_id, notebook.read(offset)) for cell_id, offset in sorted(offsets.items(), key=lambda item: item[1])]
+    except OSError as e:
+        console.print(f"[bold red]Error: Could not read {notebook.path}: {e}[/bold red]")
+        return None
+    if not offsets:
+        console.print(f"[bold red]Error: No session {session} in {notebook.path}.[/bold red]")
+        return None
+    # Cells are only replaced once the whole session has been read
+    code_output_log.clear()
+    for cell_id, record in records:
+        code_output_log.append(Cell(cell_id, record['code'], record['output'], imported_names()))
+    code_output_log.sort(key=lambda cell: cell.cell_id)
+    notebook.session = session
+    console.print(f"[bold green]Loaded {len(code_output_log)} cells from session {session}; "
+                  "run 'run:all' to rebuild their variables in the kernel.[/bold green]")
+    return code_output_log[-1].cell_id
 
 def save_to_file():
-    with open("notes.pybook", "w") as file:
-        for code, result in code_output_log:
-            file.write(f"Code:\n{code}\n\nOutput:\n{result}\n{'-'*40}\n")
-    console.print("[bold green]All cells and outputs have been saved to notes.pybook[/bold green]")
+    # Cells are appended to the log as they finish, so there is nothing left to write
+    console.print(f"[bold green]All {len(code_output_log)} cells and outputs are saved in {notebook.path}[/bold green]")
+
+def save_text_file(filename):
+    with open(filename, "w") as file:
+        for cell in code_output_log:
+            file.write(f"Code:\n{cell.code}\n\nOutput:\n{cell.output}\n{'-'*40}\n")
+    console.print(f"[bold green]All cells and outputs have been written to {filename}[/bold green]")
 
 def main():
+    from rich.prompt import Prompt
+    global use_kernel, cell_timeout
     console.print("[bold magenta]Welcome to PyBook - The Advanced Terminal Python Notebook[/bold magenta]")
     filename = Prompt.ask("[bold green]Enter the filename including extension (e.g., script.py)[/bold green]", default="script.py")
     if not filename.endswith('.py'):
         console.print("[bold red]Error: The file must have a .py extension.[/bold red]")
         return
+    open_notebook()
 
     try:
         current_cell = 1
         while True:
             console.print(f"[bold blue]Cell {current_cell}[/bold blue]")
             user_input = Prompt.ask(f"In Cell {current_cell}:", default="").strip()
+            command_span = timings.span('command', command_name(user_input), process_cpu=True).start()
 
             if user_input.startswith('code:'):
                 code = user_input[5:].strip()
                 if code:
-                    formatted_code = format_code(code)
-                    result = execute_code_in_file(filename, formatted_code)
-                    display_syntax(formatted_code)
-                    console.print(f"Output:\n{result}")
+                    if use_kernel:
+                        execute_code_in_kernel(filename, code, current_cell)
+                    else:
+                        formatted_code = format_code(code)
+                        display_syntax(formatted_code)
+                        execute_code_in_file(filename, formatted_code, current_cell)
                 else:
                     console.print("[bold red]Error: No code provided after 'code:'[/bold red]")
 
@@ -211,26 +1836,154 @@ def main():
 
             elif user_input.startswith('profile:'):
                 code = user_input[8:].strip()
-                if code:
-                    profile_code(code)
+                mode, _, rest = code.partition(' ')
+                if mode == 'sample' and rest.strip():
+                    profile_code(rest.strip(), current_cell, sampling=True)
+                elif mode == 'show' and rest.strip():
+                    parts = rest.split()
+                    show_profile(parts[0], int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None)
+                elif mode == 'diff':
+                    parts = rest.split()
+                    if len(parts) == 2:
+                        diff_profiles(parts[0], parts[1])
+                    else:
+                        console.print("[bold red]Error: Usage is 'profile:diff <before.prof> <after.prof>'[/bold red]")
+                elif code:
+                    profile_code(code, current_cell)
                 else:
                     console.print("[bold red]Error: No code provided after 'profile:'[/bold red]")
 
+            elif user_input.startswith('edit:') or user_input.startswith('rerun:'):
+                command, _, rest = user_input.partition(':')
+                cell_ref, _, code = rest.strip().partition(' ')
+                if not use_kernel:
+                    console.print(f"[bold red]Error: '{command}:' needs the kernel; run 'kernel:on' first.[/bold red]")
+                elif not cell_ref.isdigit():
+                    console.print(f"[bold red]Error: Expected a cell number after '{command}:'[/bold red]")
+                elif command == 'edit' and not code.strip():
+                    console.print("[bold red]Error: No code provided after 'edit:<cell>'[/bold red]")
+                else:
+                    rerun_cell(int(cell_ref), format_code(code.strip()) if command == 'edit' else None)
+
+            elif user_input.startswith('run:all'):
+                workers = user_input[7:].strip()
+                if not use_kernel:
+                    console.print("[bold red]Error: 'run:all' needs the kernel; run 'kernel:on' first.[/bold red]")
+                elif workers and not workers.isdigit():
+                    console.print("[bold red]Error: Expected a number of workers after 'run:all'[/bold red]")
+                else:
+                    run_all_cells(int(workers) if workers else None)
+
+            elif user_input.lower() == 'cells':
+                show_cells()
+
+            elif user_input.startswith('export:'):
+                export_name = user_input[7:].strip()
+                if export_name:
+                    export_script(export_name)
+                else:
+                    console.print("[bold red]Error: No filename provided after 'export:'[/bold red]")
+
+            elif user_input.startswith('timeout:'):
+                value = user_input[8:].strip()
+                if value.lower() in ('off', 'none', '0'):
+                    cell_timeout = None
+                    console.print("[bold green]Cell timeout disabled.[/bold green]")
+                else:
+                    try:
+                        cell_timeout = float(value)
+                        console.print(f"[bold green]Cells will be interrupted after {cell_timeout:g}s.[/bold green]")
+                    except ValueError:
+                        console.print("[bold red]Error: Expected a number of seconds or 'off' after 'timeout:'[/bold red]")
+
+            elif user_input.lower() == 'kernel:restart':
+                kernel.restart()
+                console.print("[bold green]Kernel restarted; all variables have been cleared.[/bold green]")
+
+            elif user_input.lower() == 'kernel:off':
+                use_kernel = False
+                kernel.shutdown()
+                console.print(f"[bold yellow]Kernel disabled; each cell re-runs all of {filename}.[/bold yellow]")
+
+            elif user_input.lower() == 'kernel:on':
+                if os.name == 'posix':
+                    use_kernel = True
+                    console.print("[bold green]Kernel enabled; cells share one persistent namespace.[/bold green]")
+                else:
+                    console.print("[bold red]Error: The kernel is only supported on POSIX systems.[/bold red]")
+
+            elif user_input.startswith('memprofile:'):
+                code = user_input[11:].strip()
+                if code in ('track on', 'track off', 'diff') and not use_kernel:
+                    console.print(f"[bold red]Error: 'memprofile:{code}' needs the kernel; run 'kernel:on' first.[/bold red]")
+                elif code in ('track on', 'track off'):
+                    set_memory_tracking(code == 'track on')
+                elif code == 'diff':
+                    show_memory_diff()
+                elif code:
+                    memory_profile_code(code, current_cell)
+                else:
+                    console.print("[bold red]Error: No code provided after 'memprofile:'[/bold red]")
+
+            elif user_input.startswith('bench:'):
+                stmt, _, setup = user_input[6:].partition(';;')
+                if stmt.strip():
+                    benchmark_code(stmt.strip(), setup.strip() or 'pass')
+                else:
+                    console.print("[bold red]Error: No code provided after 'bench:'[/bold red]")
+
+            elif user_input.lower() in ('stats', 'stats:'):
+                show_stats()
+
+            elif user_input.startswith('stats:'):
+                mode, _, path = user_input[6:].strip().partition(' ')
+                if mode == 'clear':
+                    timings.clear()
+                    console.print("[bold green]Timings cleared.[/bold green]")
+                elif mode in ('export', 'trace') and path.strip():
+                    export_stats(path.strip(), trace=mode == 'trace')
+                else:
+                    console.print("[bold red]Error: Usage is 'stats:', 'stats:clear', 'stats:export <file.json>' "
+                                  "or 'stats:trace <file.json>'[/bold red]")
+
             elif user_input.lower() == 'save:file':
                 save_to_file()
 
+            elif user_input.startswith('save:text'):
+                save_text_file(user_input[9:].strip() or "notes.txt")
+
+            elif user_input.startswith('load:'):
+                session, _, cell_ref = user_input[5:].strip().partition(':')
+                if not session:
+                    list_sessions()
+                elif not session.isdigit() or (cell_ref and not cell_ref.isdigit()):
+                    console.print("[bold red]Error: Usage is 'load:', 'load:<session>' or 'load:<session>:<cell>'[/bold red]")
+                elif cell_ref:
+                    show_saved_cell(int(session), int(cell_ref))
+                else:
+                    last_cell = load_session(int(session))
+                    if last_cell is not None:
+                        current_cell = max(current_cell, last_cell)
+
             elif user_input.lower() == 'exit' or user_input.lower() == 'quit':
                 console.print("[bold red]Exiting PyBook.[/bold red]")
+                kernel.shutdown()
                 return
 
             else:
                 console.print("[bold red]Error: Unknown command. Type 'help' for a list of commands.[/bold red]")
 
+            command_span.stop()
             current_cell += 1
 
     except KeyboardInterrupt:
         console.print("\n[bold red]Exiting PyBook.[/bold red]")
+        kernel.shutdown()
         sys.exit(0)
 
 if __name__ == '__main__':
-    main() 
+    if len(sys.argv) == 4 and sys.argv[1] == '--kernel':
+        run_kernel(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        main()
+
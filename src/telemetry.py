@@ -0,0 +1,183 @@
+"""In-memory timing telemetry shared by PyBook and BookLAB.
+
+Every span records its wall time and CPU time into a fixed-size ring buffer,
+so instrumentation stays on for a whole session without growing. Spans are
+grouped by (category, name) for percentile summaries, and can be exported as
+plain JSON or as a Chrome trace-event file for chrome://tracing or Perfetto.
+Only the standard library is used, and the buffer is a plain list guarded by
+a _thread lock, since threading and collections would cost BookLAB most of
+its import budget.
+"""
+import os
+import time
+from _thread import allocate_lock, get_ident
+
+
+def percentile(ordered, fraction):
+    """Linearly interpolated percentile of an already sorted, non-empty list."""
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class Span:
+    """Times one operation; use it as a context manager, or call start() and stop().
+
+    CPU time is the calling thread's by default. Spans that hand work to other
+    threads or wait on them, such as whole commands, use process_cpu to count
+    the CPU time of every thread instead. The name may be changed before the
+    span stops, to tell apart, say, cache hits from misses.
+    """
+
+    __slots__ = ("telemetry", "category", "name", "cpu_clock", "started", "cpu_started")
+
+    def __init__(self, telemetry, category, name, process_cpu=False):
+        self.telemetry = telemetry
+        self.category = category
+        self.name = name
+        self.cpu_clock = time.process_time if process_cpu else time.thread_time
+        self.started = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.cpu_started = self.cpu_clock()
+        return self
+
+    def stop(self):
+        if self.started is None:
+            return
+        wall = time.perf_counter() - self.started
+        cpu = self.cpu_clock() - self.cpu_started
+        self.telemetry.record(self.category, self.name, self.started, wall, cpu)
+        self.started = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class Telemetry:
+    """A ring buffer of (category, name, start, wall, cpu, thread) spans.
+
+    Once capacity spans are held, each new span overwrites the oldest one;
+    dropped counts how many have been overwritten. Spans may be recorded
+    from any thread.
+    """
+
+    def __init__(self, capacity=10_000):
+        self.capacity = capacity
+        self.buffer = []
+        self.position = 0
+        self.dropped = 0
+        self.lock = allocate_lock()
+        self.origin = time.perf_counter()
+
+    def span(self, category, name, process_cpu=False):
+        return Span(self, category, name, process_cpu)
+
+    def record(self, category, name, start, wall, cpu):
+        span = (category, name, start, wall, cpu, get_ident())
+        with self.lock:
+            if len(self.buffer) < self.capacity:
+                self.buffer.append(span)
+            else:
+                self.buffer[self.position] = span
+                self.position = (self.position + 1) % self.capacity
+                self.dropped += 1
+
+    def spans(self):
+        """The buffered spans, oldest first."""
+        with self.lock:
+            return self.buffer[self.position:] + self.buffer[:self.position]
+
+    def timed(self, category, name=None):
+        """Decorator that records every call of a function as a span named after it."""
+        def decorate(func):
+            label = name or func.__name__
+
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                cpu_started = time.thread_time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(category, label, started, time.perf_counter() - started,
+                                time.thread_time() - cpu_started)
+            # Copied by hand rather than with functools.wraps, for the same import cost reason
+            wrapper.__name__, wrapper.__qualname__ = func.__name__, func.__qualname__
+            wrapper.__doc__, wrapper.__wrapped__ = func.__doc__, func
+            return wrapper
+        return decorate
+
+    def clear(self):
+        with self.lock:
+            self.buffer = []
+            self.position = 0
+            self.dropped = 0
+
+    def summary(self):
+        """Per (category, name) counts, totals and wall-time percentiles, busiest first; times in seconds."""
+        groups = {}
+        for category, name, _, wall, cpu, _ in self.spans():
+            walls, cpus = groups.setdefault((category, name), ([], []))
+            walls.append(wall)
+            cpus.append(cpu)
+        rows = []
+        for (category, name), (walls, cpus) in groups.items():
+            walls.sort()
+            rows.append({"category": category, "name": name, "count": len(walls), "total": sum(walls),
+                         "p50": percentile(walls, 0.5), "p90": percentile(walls, 0.9),
+                         "p99": percentile(walls, 0.99), "max": walls[-1], "cpu": sum(cpus)})
+        rows.sort(key=lambda row: row["total"], reverse=True)
+        return rows
+
+    def summary_table(self, format_duration):
+        """The summary as a rich Table, with times shown by format_duration; None if nothing is recorded.
+
+        rich is imported here, not at the top, so importing this module stays cheap.
+        """
+        from rich.table import Table
+        rows = self.summary()
+        if not rows:
+            return None
+        caption = (f"Only the last {self.capacity} of {self.capacity + self.dropped} timings are kept."
+                   if self.dropped else None)
+        table = Table(title="Timings", caption=caption, style="cyan")
+        table.add_column("Category", justify="left")
+        table.add_column("Name", justify="left")
+        for column in ("Count", "Total", "p50", "p90", "p99", "Max", "CPU"):
+            table.add_column(column, justify="right")
+        for row in rows:
+            table.add_row(row["category"], row["name"], str(row["count"]),
+                          *(format_duration(row[key]) for key in ("total", "p50", "p90", "p99", "max", "cpu")))
+        return table
+
+    def export_report(self, path, trace=False):
+        """Export the spans as export() does and return a message saying what was written."""
+        count = self.export(path, trace)
+        return f"[bold green]Wrote {count} timings to {path} as {'Chrome trace' if trace else 'JSON'}[/bold green]"
+
+    def export(self, path, trace=False):
+        """Write the buffered spans to path as JSON, or as Chrome trace events when trace is set.
+
+        Returns the number of spans written.
+        """
+        import json
+        spans = self.spans()
+        if trace:
+            pid = os.getpid()
+            data = {"displayTimeUnit": "ms", "traceEvents": [
+                {"name": name, "cat": category, "ph": "X", "pid": pid, "tid": thread,
+                 "ts": (start - self.origin) * 1e6, "dur": wall * 1e6, "args": {"cpu_ms": cpu * 1e3}}
+                for category, name, start, wall, cpu, thread in spans]}
+        else:
+            data = {"dropped": self.dropped, "summary": self.summary(), "spans": [
+                {"category": category, "name": name, "start": start - self.origin, "wall": wall, "cpu": cpu,
+                 "thread": thread}
+                for category, name, start, wall, cpu, thread in spans]}
+        with open(path, "w") as file:
+            json.dump(data, file, indent=1 if not trace else None)
+        return len(spans)
@@ -0,0 +1,80 @@
+"""Check that importing PyBook and BookLAB stays within its time budget.
+
+Usage: python tests/check_import_time.py [runs]
+
+Each module is imported in a fresh interpreter under `python -X importtime`,
+after a warm-up import so bytecode is cached the way it is for a normal
+launch. Absolute times swing with machine load, so each run's import time is
+divided by the time the same interpreter spent importing `site`, and the
+lowest of these ratios is compared with IMPORT_BUDGETS. The import must also
+not pull in any of LAZY_MODULES, which the commands load when they are first
+used; unlike the timing, that check is exact. Exits with status 1 if any
+check fails. test_import_time.py, next to this script, runs the same checks
+under pytest.
+"""
+import os
+import sys
+import subprocess
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+# Import time as a multiple of `site`'s in the same interpreter; measured at about 7 and 0.35
+IMPORT_BUDGETS = {'pybook': 15, 'booklab': 2}
+LAZY_MODULES = ('rich', 'pygments', 'autopep8', 'pycodestyle', 'cProfile', 'pstats', 'multiprocessing', 'difflib')
+
+
+def run_import(pycache, code):
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=pycache)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SRC_DIR, env=env,
+                          capture_output=True, text=True, check=True)
+
+
+def import_times_ms(module, pycache):
+    """Return the cumulative import times of module and of site, from one interpreter."""
+    result = run_import(pycache, f"import {module}")
+    times = {}
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() in (module, 'site') and not parts[2].startswith('  '):
+            times[parts[2].strip()] = int(parts[1]) / 1000
+    if len(times) != 2:
+        raise RuntimeError(f"no importtime entry for {module} or site")
+    return times[module], times['site']
+
+
+def relative_import_time(module, pycache, runs=5):
+    """Return (ratio, ms) for the run whose import time is the smallest multiple of site's."""
+    import_times_ms(module, pycache)
+    best = None
+    for _ in range(runs):
+        module_ms, site_ms = import_times_ms(module, pycache)
+        if best is None or module_ms / site_ms < best[0]:
+            best = (module_ms / site_ms, module_ms)
+    return best
+
+
+def eager_imports(module, pycache):
+    code = f"import sys, {module}; print(' '.join(sorted(sys.modules)))"
+    loaded = set(run_import(pycache, code).stdout.split())
+    return [name for name in LAZY_MODULES if name in loaded]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    failed = False
+    with tempfile.TemporaryDirectory() as pycache:
+        for module, budget in IMPORT_BUDGETS.items():
+            ratio, module_ms = relative_import_time(module, pycache, runs)
+            eager = eager_imports(module, pycache)
+            ok = ratio <= budget and not eager
+            failed = failed or not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {module}: {module_ms:.1f} ms, {ratio:.2f}x site (budget {budget}x)")
+            if eager:
+                print(f"     imported at load time: {', '.join(eager)}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
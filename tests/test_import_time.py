@@ -0,0 +1,20 @@
+import pytest
+
+import check_import_time
+
+
+@pytest.fixture(scope='module')
+def pycache(tmp_path_factory):
+    return str(tmp_path_factory.mktemp('pycache'))
+
+
+@pytest.mark.parametrize('module', sorted(check_import_time.IMPORT_BUDGETS))
+def test_heavy_modules_are_imported_lazily(module, pycache):
+    assert check_import_time.eager_imports(module, pycache) == []
+
+
+@pytest.mark.parametrize('module', sorted(check_import_time.IMPORT_BUDGETS))
+def test_import_time_within_budget(module, pycache):
+    ratio, module_ms = check_import_time.relative_import_time(module, pycache)
+    budget = check_import_time.IMPORT_BUDGETS[module]
+    assert ratio <= budget, f"importing {module} took {module_ms:.1f} ms, {ratio:.2f}x site (budget {budget}x)"